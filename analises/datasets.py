@@ -0,0 +1,209 @@
+import os
+import pandas as pd
+from glob import glob
+
+import xavy.cache as xca
+import xavy.clouds as cl
+import prodes as pr
+
+
+class LazyTable:
+    """
+    A table stored in a cached columnar file
+    (see `xavy.cache`), which is only read when
+    `collect` is called, and then only the
+    selected columns and the rows that satisfy
+    the filters.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the cached file.
+    year_col : str or None
+        Column with years, used by `years`.
+    uf_col : str or None
+        Column with states, used by `ufs`.
+    municipio_col : str or None
+        Column with municipality codes, used by
+        `municipios`.
+    columns : list of str or None
+        Columns to read. If None, read all.
+    filters : list of tuples
+        Filters (column, operator, value) that
+        rows must satisfy (see
+        `xavy.cache.apply_filters`).
+    """
+
+    def __init__(self, filename, year_col=None, uf_col=None, municipio_col=None, columns=None, filters=None):
+        self.filename      = filename
+        self.year_col      = year_col
+        self.uf_col        = uf_col
+        self.municipio_col = municipio_col
+        self.columns       = columns
+        self.filters       = [] if filters is None else list(filters)
+
+    def copy(self, columns=None, filters=None):
+        """
+        Return a new LazyTable like this one, with
+        `columns` (list of str) replacing the selected
+        columns and `filters` (list of tuples) added
+        to the current filters.
+        """
+        return LazyTable(self.filename, self.year_col, self.uf_col, self.municipio_col,
+                         self.columns if columns is None else list(columns),
+                         self.filters + ([] if filters is None else list(filters)))
+
+    def select(self, columns):
+        """
+        Only read `columns` (str or list of str).
+        """
+        if type(columns) == str:
+            columns = [columns]
+        return self.copy(columns=columns)
+
+    def where(self, col, op, value):
+        """
+        Only read rows where column `col` (str)
+        satisfies the comparison `op` (str, e.g.
+        '==' or 'in') against `value`.
+        """
+        return self.copy(filters=[(col, op, value)])
+
+    def years(self, first_year=None, last_year=None):
+        """
+        Only read rows from `first_year` (int or
+        None) to `last_year` (int or None), inclusive.
+        """
+        assert self.year_col is not None, 'This table has no year column.'
+        filters = []
+        if first_year is not None:
+            filters.append((self.year_col, '>=', first_year))
+        if last_year is not None:
+            filters.append((self.year_col, '<=', last_year))
+        return self.copy(filters=filters)
+
+    def ufs(self, ufs):
+        """
+        Only read rows from states `ufs` (str or
+        list of str).
+        """
+        assert self.uf_col is not None, 'This table has no state column.'
+        if type(ufs) == str:
+            ufs = [ufs]
+        return self.where(self.uf_col, 'in', list(ufs))
+
+    def municipios(self, codes):
+        """
+        Only read rows from municipalities `codes`
+        (list).
+        """
+        assert self.municipio_col is not None, 'This table has no municipality column.'
+        return self.where(self.municipio_col, 'in', list(codes))
+
+    def collect(self):
+        """
+        Read the selected columns and filtered
+        rows from the cached file.
+
+        Returns a DataFrame.
+        """
+        filters = self.filters if len(self.filters) > 0 else None
+        return xca.read_frame(self.filename, self.columns, filters)
+
+    def __repr__(self):
+        return 'LazyTable({}, columns={}, filters={})'.format(os.path.basename(self.filename), self.columns, self.filters)
+
+
+def default_cache_dir(filename):
+    """
+    Return the cache directory (str) used for
+    data read from `filename` (str): a '.cache'
+    directory next to it.
+    """
+    return os.path.join(os.path.dirname(filename), '.cache')
+
+
+def prodes_table(prefix, first_year, last_year, extension='.txt', cache_dir=None, row_group_size=10000):
+    """
+    Return a LazyTable of Prodes deflorestation
+    data, as returned by `prodes.etl_prodes_data`,
+    stored in `cache_dir` (str or None, defaults
+    to a '.cache' directory next to the CSV files)
+    sorted by year and state in row groups of
+    `row_group_size` (int) rows.
+    """
+
+    if cache_dir is None:
+        cache_dir = default_cache_dir(prefix)
+    filenames = pr.prodes_filenames(prefix, first_year, last_year, extension)
+    name = '{}{}-{}_etl'.format(os.path.basename(prefix), first_year, last_year)
+
+    def loader():
+        return pr.etl_prodes_data(prefix, first_year, last_year, extension, use_cache=False)
+
+    filename = xca.cached_file(loader, filenames, cache_dir, name, sort_by=['Ano', 'Estado'], row_group_size=row_group_size)
+
+    return LazyTable(filename, year_col='Ano', uf_col='Estado', municipio_col='CodIbge')
+
+
+def deter_table(filename, year_col='year', uf_col='uf', municipio_col='municipio', date_col=None, date_format=None, cache_dir=None, row_group_size=10000):
+    """
+    Return a LazyTable of DETER deflorestation
+    alerts loaded from the CSV `filename` (str)
+    downloaded from TerraBrasilis.
+
+    If `date_col` (str) is provided, parse it as
+    dates with `date_format` (str or None) and
+    add a `year_col` (str) column from it (e.g.
+    for the daily municipal data, whose dates are
+    in 'viewDate' with format '%m/%d/%Y'). The
+    cached copy is stored in `cache_dir` (str or
+    None, defaults to a '.cache' directory next
+    to the CSV file), sorted by year and state in
+    row groups of `row_group_size` (int) rows.
+    """
+
+    if cache_dir is None:
+        cache_dir = default_cache_dir(filename)
+    name = os.path.splitext(os.path.basename(filename))[0]
+
+    def loader():
+        df = pd.read_csv(filename)
+        if date_col is not None:
+            df[date_col] = pd.to_datetime(df[date_col], format=date_format)
+            df[year_col] = df[date_col].dt.year
+        sort_by = [col for col in [year_col, uf_col] if col in df.columns]
+        return df.sort_values(sort_by, kind='stable', ignore_index=True)
+
+    filename = xca.cached_file(loader, [filename], cache_dir, name, extra=[date_col, date_format, year_col], row_group_size=row_group_size)
+
+    return LazyTable(filename, year_col=year_col, uf_col=uf_col, municipio_col=municipio_col)
+
+
+def siga_table(file_pattern, ipca_file, cache_dir=None, row_group_size=10000):
+    """
+    Return a LazyTable of SIGA Brasil orçamento
+    data, as returned by `sigabrasil.etl_sigabrasil`
+    for the files in glob pattern `file_pattern`
+    (str) and IPCA data in `ipca_file` (str). The
+    cached copy is stored in `cache_dir` (str or
+    None, defaults to a '.cache' directory next
+    to the first file), sorted by year and month
+    in row groups of `row_group_size` (int) rows.
+    """
+    import sigabrasil as sb
+
+    filenames = sorted(glob(file_pattern))
+    assert len(filenames) > 0, 'No file found for pattern {}'.format(file_pattern)
+    if cache_dir is None:
+        cache_dir = default_cache_dir(filenames[0])
+    name = 'siga_' + os.path.splitext(os.path.basename(filenames[0]))[0]
+
+    def loader():
+        return sb.etl_sigabrasil(file_pattern, ipca_file)
+
+    ipca_local   = cl.local_data_file(ipca_file)
+    source_files = filenames + ([] if ipca_local is None else [ipca_local])
+    filename = xca.cached_file(loader, source_files, cache_dir, name, extra=file_pattern, sort_by=['Ano', 'Mês (Número) DES'], row_group_size=row_group_size)
+
+    return LazyTable(filename, year_col='Ano')
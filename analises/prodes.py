@@ -1,9 +1,18 @@
+import os
+import numpy as np
 import pandas as pd
 import re
 
+import xavy.cache as xca
+import xavy.dataframes as xd
+import xavy.utils as xu
+
 
 # Prodes data columns with areas (km2):
 areas_col = ['Incremento', 'AreaKm2', 'Desmatado', 'Floresta', 'Nuvem', 'NaoObservado', 'NaoFloresta', 'Hidrografia', 'Desmatavel', 'Disponivel']
+# Prodes data columns with names and codes that repeat every year:
+names_col = ['Estado', 'Municipio']
+codes_col = ['CodIbge']
 
 
 def load_one_prodes_csv(prefix, year, std_cols=True, extension='.txt'):
@@ -39,17 +48,50 @@ def load_one_prodes_csv(prefix, year, std_cols=True, extension='.txt'):
     return df[['Ano'] + new_cols]
 
 
-def load_prodes_csv_data(prefix, first_year, last_year, extension='.txt'):
+def prodes_filenames(prefix, first_year, last_year, extension='.txt'):
+    """
+    Return the list of Prodes CSV files (str) with
+    prefix (including path) `prefix` (str) for years
+    from `first_year` (int) to `last_year` (int)
+    (inclusive).
+    """
+    return ['{}{}{}'.format(prefix, year, extension) for year in range(first_year, last_year + 1)]
+
+
+def load_prodes_csv_data(prefix, first_year, last_year, extension='.txt', use_cache=True, cache_dir=None, n_jobs=None, backend='thread'):
     """
     Load deflorestation INPE Prodes Data
     from CSV files with prefix (including
     path) `prefix` (str), for years from 
     `first_year` (int) to `last_year` (int)
     (inclusive).
+    
+    If `use_cache` is True, save the loaded 
+    data to a columnar file in `cache_dir` 
+    (str) and load it from there in later 
+    calls, unless the CSV files changed. If 
+    `cache_dir` is None, use a '.cache' 
+    directory next to the CSV files.
+    
+    The yearly files are read by up to `n_jobs` 
+    (int or None, -1 for all CPUs) workers of 
+    a `backend` ('thread' or 'process') pool. 
     """
     
-    # Carrega dados:
-    df = pd.concat([load_one_prodes_csv(prefix, year, extension) for year in range(first_year, last_year + 1)], ignore_index=True)
+    def load_csvs():
+        args_list = [(prefix, year, True, extension) for year in range(first_year, last_year + 1)]
+        df_list = xu.parallel_map(load_one_prodes_csv, args_list, n_jobs, backend)
+        return pd.concat(xd.unify_dtypes(df_list), ignore_index=True)
+    
+    if not use_cache:
+        return load_csvs()
+    
+    # Carrega dados do cache ou dos CSVs:
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(prefix), '.cache')
+    filenames = prodes_filenames(prefix, first_year, last_year, extension)
+    name = '{}{}-{}'.format(os.path.basename(prefix), first_year, last_year)
+    df = xca.cached_frame(load_csvs, filenames, cache_dir, name)
     
     return df
 
@@ -73,24 +115,270 @@ def add_prodes_extra_cols(df):
     return df
 
 
-def etl_prodes_data(prefix, first_year, last_year, extension='.txt'):
+def compact_prodes_dtypes(df, atol=0.01, verbose=True):
+    """
+    Reduce the memory used by the Prodes 
+    deflorestation dataset `df` (DataFrame).
+    
+    Columns in `areas_col` become float32 if
+    the conversion changes no value by more 
+    than `atol` (float, in km2), columns in 
+    `names_col` become categorical and 'Ano' 
+    and columns in `codes_col` become the 
+    smallest integer type that holds them. 
+    If `verbose` is True, print the memory 
+    saved.
+    
+    Returns a DataFrame.
+    """
+    
+    mem_before = df.memory_usage(deep=True).sum()
+    df = df.copy()
+    
+    # Areas:
+    for col in filter(lambda c: c in df.columns, areas_col):
+        values = df[col].to_numpy(dtype=float)
+        compact = values.astype(np.float32)
+        if np.nanmax(np.abs(compact - values), initial=0) <= atol:
+            df[col] = compact
+    
+    # Names:
+    for col in filter(lambda c: c in df.columns, names_col):
+        df[col] = df[col].astype('category')
+    
+    # Years and codes:
+    for col in filter(lambda c: c in df.columns, ['Ano'] + codes_col):
+        if df[col].notnull().all():
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+    
+    if verbose:
+        mem_after = df.memory_usage(deep=True).sum()
+        print('Memory usage: {:.1f} MB -> {:.1f} MB ({:.1f}x smaller)'.format(mem_before / 1e6, mem_after / 1e6, mem_before / mem_after))
+    
+    return df
+
+
+def etl_prodes_data(prefix, first_year, last_year, extension='.txt', use_cache=True, cache_dir=None, n_jobs=None, backend='thread', compact=False):
     """
     Load, clean and process Prodes deflorestation
-    data.
+    data. See `load_prodes_csv_data` for the 
+    cache and parallelization parameters. If 
+    `compact` is True, use smaller dtypes (see 
+    `compact_prodes_dtypes`).
     """
     
     # Load data:
-    df = load_prodes_csv_data(prefix, first_year, last_year, extension)
+    df = load_prodes_csv_data(prefix, first_year, last_year, extension, use_cache, cache_dir, n_jobs, backend)
     # Add new columns:
     df = add_prodes_extra_cols(df)
+    # Reduce memory usage:
+    if compact:
+        df = compact_prodes_dtypes(df)
+    
+    return df
+
+
+def update_prodes_data(prefix, first_year, last_year, base_file, extension='.txt', n_jobs=None, backend='thread', verbose=True):
+    """
+    Incrementally update a persisted Prodes 
+    deflorestation dataset.
+    
+    Parameters
+    ----------
+    prefix : str
+        Prefix (including path) of the Prodes CSV
+        files (see `load_prodes_csv_data`).
+    first_year : int
+        First year to keep in the dataset.
+    last_year : int
+        Last year to keep in the dataset (inclusive).
+    base_file : str
+        Path to the persisted dataset ('.parquet' or 
+        '.pkl', see `xavy.cache.write_frame`). The 
+        signatures of the CSV file used for each year 
+        are saved in a JSON file next to it.
+    extension : str
+        Extension of the CSV files.
+    n_jobs : int or None
+        Number of workers used to load the new years
+        (see `xavy.utils.parallel_map`).
+    backend : str
+        Either 'thread' or 'process'.
+    verbose : bool
+        Whether to print which years were (re)loaded.
+    
+    Returns
+    -------
+    df : DataFrame
+        The same as `etl_prodes_data` output, where 
+        only the years whose CSV files are new or 
+        changed since the last update were loaded 
+        and processed.
+    """
+    
+    years = list(range(first_year, last_year + 1))
+    filenames = prodes_filenames(prefix, first_year, last_year, extension)
+    signatures = {str(year): xca.files_signature([filename]) for year, filename in zip(years, filenames)}
+    
+    # Load base table:
+    if os.path.isfile(base_file):
+        base_df = xca.read_frame(base_file)
+        old_signatures = xca.read_sidecar(base_file).get('signatures', {})
+    else:
+        base_df = None
+        old_signatures = {}
+    
+    # Find years to (re)load:
+    new_years = [year for year in years if old_signatures.get(str(year)) != signatures[str(year)]]
+    if verbose:
+        print('Years to load:', new_years)
+    if len(new_years) == 0 and base_df is not None and set(base_df['Ano']) == set(years):
+        return base_df
+    
+    # Load and process new data:
+    df_list = []
+    if base_df is not None:
+        df_list.append(base_df.loc[base_df['Ano'].isin(years) & ~base_df['Ano'].isin(new_years)])
+    if len(new_years) > 0:
+        args_list = [(prefix, year, True, extension) for year in new_years]
+        new_df = pd.concat(xd.unify_dtypes(xu.parallel_map(load_one_prodes_csv, args_list, n_jobs, backend)), ignore_index=True)
+        df_list.append(add_prodes_extra_cols(new_df))
+    df = pd.concat(xd.unify_dtypes(df_list), ignore_index=True)
+    df = df.sort_values('Ano', kind='stable', ignore_index=True)
+    
+    # Save:
+    xca.write_frame(df, base_file)
+    xca.write_sidecar(base_file, {'prefix': prefix, 'extension': extension, 'signatures': signatures})
     
     return df
 
 
-def date_series_to_ano_prodes(series):
+def date_to_ano_prodes(dates, first_month=8, int_unit='ns'):
+    """
+    Translate dates into Prodes years (or other
+    fiscal years) without going through pandas
+    `.dt` accessors.
+    
+    Parameters
+    ----------
+    dates : array-like
+        The dates, either as datetime64 values, as 
+        integers counting `int_unit` since 1970-01-01
+        (e.g. the int64 representation of 
+        datetime64[ns]) or as strings starting with 
+        'YYYY-MM' (e.g. 'YYYY-MM-DD'), which are not 
+        fully parsed (strings in other formats are 
+        parsed by pandas, and invalid ones raise an 
+        error).
+    first_month : int
+        The month (1 to 12) when the year starts. 
+        For Prodes (8), the year Y goes from 
+        01/08/Y-1 to 31/07/Y. If 1, return the 
+        calendar year.
+    int_unit : str
+        Time unit of integer `dates`.
+    
+    Returns
+    -------
+    anos : array
+        The years, as integers (or floats, with NaN
+        for missing dates).
+    """
+    
+    values = np.asarray(dates)
+    # Months after the start of the year:
+    offset = (13 - first_month) % 12
+    
+    # Strings: read the digits directly from the unicode code points:
+    if values.dtype.kind in 'OUS':
+        missing = pd.isnull(values)
+        chars  = np.where(missing, '', values).astype('U8').view(np.uint32).reshape(-1, 8).astype(np.int64)
+        digits = chars - ord('0')
+        year  = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+        month = digits[:, 5] * 10 + digits[:, 6]
+        anos  = year + (month + offset - 1) // 12
+        
+        # Strings not in format 'YYYY-MM[-...]' are parsed one by one:
+        digit_pos = [0, 1, 2, 3, 5, 6]
+        valid = ((digits[:, digit_pos] >= 0) & (digits[:, digit_pos] <= 9)).all(axis=1) & (chars[:, 4] == ord('-')) 
+        valid &= ((chars[:, 7] == ord('-')) | (chars[:, 7] == 0)) & (month >= 1) & (month <= 12)
+        other = ~valid & ~missing
+        if other.any():
+            parsed = date_to_ano_prodes(np.array([pd.Timestamp(v).to_datetime64() for v in values[other]], dtype='datetime64[ns]'), first_month)
+            anos = anos.astype(parsed.dtype)
+            anos[other] = parsed
+        
+        if missing.any():
+            anos = np.where(missing, np.nan, anos)
+        
+        return anos
+    
+    # Integers and datetimes: 
+    if values.dtype.kind in 'iu':
+        values = values.astype(np.int64).view('datetime64[{}]'.format(int_unit))
+    missing = np.isnat(values)
+    unit, count = np.datetime_data(values.dtype)
+    if missing.all():
+        return np.full(len(values), np.nan)
+    
+    # Coarse units: count months since 1970-01:
+    if unit in ['Y', 'M', 'W', 'D']:
+        months = values.astype('datetime64[M]').astype(np.int64)
+        anos = (months + offset) // 12 + 1970
+    
+    # Fine units: integer division into days and lookup of the year of each day:
+    else:
+        ticks_per_day = np.timedelta64(1, 'D') // np.timedelta64(count, unit)
+        days = values.view(np.int64) // ticks_per_day
+        if missing.any():
+            days[missing] = days[~missing].min()
+        first_day = days.min()
+        days -= first_day
+        months = np.arange(first_day, first_day + days.max() + 1).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        day_to_ano = (months + offset) // 12 + 1970
+        anos = day_to_ano[days]
+    
+    if missing.any():
+        anos = np.where(missing, np.nan, anos)
+    
+    return anos
+
+
+def date_series_to_ano_prodes(series, first_month=8):
     """
     Translate a datetime Series `series`
     into a Prodes year. The Prodes year 
-    Y goes from 01/08/Y-1 to 31/07/Y.
+    Y goes from 01/08/Y-1 to 31/07/Y. 
+    Other fiscal years can be obtained 
+    by changing `first_month` (int). See
+    `date_to_ano_prodes` for details.
+    """
+    
+    # Use local time for timezone-aware dates:
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        series = series.dt.tz_localize(None)
+    
+    return pd.Series(date_to_ano_prodes(series.to_numpy(), first_month), index=series.index, name=series.name)
+
+
+def count_by_ano_prodes(chunks, date_col='data', first_month=8):
     """
-    return series.dt.year + (series.dt.month >= 8).astype(int)
+    Count the rows in `chunks` (iterable of 
+    DataFrames, e.g. from 
+    `xavy.clouds.load_chunks_from_local_or_bigquery`)
+    per Prodes year of their dates in column
+    `date_col` (str), holding only one chunk 
+    in memory at a time.
+    
+    Returns a Series of counts indexed by 
+    Prodes year.
+    """
+    
+    counts = pd.Series(dtype=np.int64)
+    for chunk in chunks:
+        anos = date_series_to_ano_prodes(pd.to_datetime(chunk[date_col]), first_month)
+        counts = counts.add(anos.value_counts(), fill_value=0)
+    counts = counts.astype(np.int64).sort_index()
+    counts.index.name = 'ano_prodes'
+    
+    return counts
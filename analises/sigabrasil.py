@@ -1,27 +1,72 @@
+import os
+import json
+import hashlib
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as pl
 from glob import glob
 
-import utils as xu
-
-
-def load_sigabrasil_file(filename, drop_month_0=True):
+import xavy.cache as xca
+import xavy.clouds as cl
+import xavy.dataframes as xd
+import xavy.economy as xe
+from xavy.utils import parallel_map
+
+
+# Standardizing dict (órgãos superiores):
+ministerio_dict = {
+    'MINIST.DA CIENCIA,TECNOL.,INOV.E COMUNICACOES':'MINISTERIO DA CIENCIA E TECNOLOGIA',
+    'MINISTERIO DA CIENCIA, TECNOLOGIA E INOVACAO': 'MINISTERIO DA CIENCIA E TECNOLOGIA',
+    'MINISTERIO DA CIENCIA, TECNOLOGIA E INOVACOES': 'MINISTERIO DA CIENCIA E TECNOLOGIA',
+    'MINISTERIO DA INTEGRACAO NACIONAL': 'MINISTERIO DO DESENVOLVIMENTO REGIONAL',
+    'MINISTERIO DA JUSTICA E CIDADANIA': 'MINISTERIO DA JUSTICA',
+    'MINISTERIO DA JUSTICA E SEGURANCA PUBLICA': 'MINISTERIO DA JUSTICA',
+    'MINIST. DO PLANEJAMENTO, DESENVOLV. E GESTAO': 'MINISTERIO DA ECONOMIA',
+    'MINISTERIO DO PLANEJAMENTO,ORCAMENTO E GESTAO': 'MINISTERIO DA ECONOMIA',
+    'MINISTERIO DA FAZENDA':'MINISTERIO DA ECONOMIA',
+    'MINISTERIO DO TRABALHO E EMPREGO':'MINISTERIO DA ECONOMIA',
+    'MINISTERIO DA PESCA E AQÜICULTURA':'MINISTERIO DA AGRICULTURA, PECUARIA E ABASTECIMENTO',
+    'MINIST. DA AGRICUL.,PECUARIA E ABASTECIMENTO':'MINISTERIO DA AGRICULTURA, PECUARIA E ABASTECIMENTO'
+}
+# Standardizing dict (órgão):
+orgao_dict = {
+    'COMPANHIA DE DESENV. DO VALE DO SAO FRANCISCO':'CIA.DE DES.DOS VALES DO S.FRANC.E DO PARNAIBA',
+    'MINIST. DA AGRICUL.,PECUARIA E ABASTECIMENTO':'MINISTERIO DA AGRICULTURA, PECUARIA E ABASTECIMENTO',
+    'MINIST. DO PLANEJAMENTO, DESENVOLV. E GESTAO':'MINISTERIO DA ECONOMIA',
+    'MINISTERIO DO PLANEJAMENTO,ORCAMENTO E GESTAO': 'MINISTERIO DA ECONOMIA',
+    'MINIST.DA CIENCIA,TECNOL.,INOV.E COMUNICACOES':'MINISTERIO DA CIENCIA E TECNOLOGIA',
+    'MINISTERIO DA CIENCIA, TECNOLOGIA E INOVACAO':'MINISTERIO DA CIENCIA E TECNOLOGIA',
+    'MINISTERIO DA INTEGRACAO NACIONAL':'MINISTERIO DO DESENVOLVIMENTO REGIONAL',
+    'MINISTERIO DA FAZENDA':'MINISTERIO DA ECONOMIA',
+    'MINISTERIO DO TRABALHO E EMPREGO':'MINISTERIO DA ECONOMIA',
+    'MINISTERIO DA JUSTICA E CIDADANIA':'MINISTERIO DA JUSTICA',
+    'MINISTERIO DA JUSTICA E SEGURANCA PUBLICA':'MINISTERIO DA JUSTICA',
+    'MINISTERIO DA PESCA E AQÜICULTURA':'MINISTERIO DA AGRICULTURA, PECUARIA E ABASTECIMENTO'
+}
+
+# Unwanted entries (see `remove_unwanted_siga_data`):
+unwanted_funcoes = ['PREVIDÊNCIA SOCIAL', 'ENCARGOS ESPECIAIS']
+unwanted_elementos_despesa = ['SENTENCAS JUDICIAIS', 'AUXÍLIO FINANCEIRO A PESQUISADORES', 'AUXÍLIO FINANCEIRO A ESTUDANTES', 
+                              'PREMIAÇÕES CULTURAIS, ARTÍSTICAS, CIENTÍFICAS, DESPORTIVAS E OUTRAS', 'PENSOES ESPECIAIS', 
+                              'DEPOSITOS COMPULSORIOS', 'EQUALIZAÇÃO DE PREÇOS E TAXAS']
+unwanted_gnds = ['PESSOAL E ENCARGOS SOCIAIS', 'JUROS E ENCARGOS DA DIVIDA', 'RESERVA DE CONTINGENCIA', 'AMORTIZACAO DA DIVIDA']
+
+
+def read_sigabrasil_file(filename, drop_month_0=True):
     """
-    Load SIGABrasil data stored in a XLS file.
-    
-    The data is supposed to be obtained from 
-    the Painel Especialista in SIGA Brasil 
-    website.
+    Read SIGABrasil data stored in a XLS file,
+    without using the cache (see 
+    `load_sigabrasil_file`).
     """
     
     # Carregando os dados:
     siga = pd.read_excel(filename)
     
     # Limpeza:
-    siga = siga.iloc[1:].reset_index(drop=True)
+    siga = siga.iloc[1:].reset_index(drop=True).infer_objects()
     siga['Mês (Número) DES'] = siga['Mês (Número) DES'].astype(int)
     if drop_month_0:
-        siga = siga.loc[siga['Mês (Número) DES'] != 0]
+        siga = siga.loc[siga['Mês (Número) DES'] != 0].reset_index(drop=True)
     siga['Ano'] = siga['Ano'].astype(int)
     #siga['Subfunção (Cod) (Ajustado)'] = siga['Subfunção (Cod) (Ajustado)'].astype(int)
     #siga['Função (Cod) DESP'] = siga['Função (Cod) DESP'].astype(int)
@@ -29,92 +74,199 @@ def load_sigabrasil_file(filename, drop_month_0=True):
     return siga
 
 
-def load_sigabrasil(file_pattern, drop_month_0=True):
+def sigabrasil_cache_dir(filename, cache_dir=None):
+    """
+    Return the directory (str) where the cache 
+    of SIGA Brasil file `filename` (str) is stored:
+    `cache_dir` (str) or, if it is None, a '.cache'
+    directory next to `filename`.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(filename), '.cache')
+    return cache_dir
+
+
+def cache_sigabrasil_file(filename, drop_month_0=True, cache_dir=None, content_hash=False):
+    """
+    Make sure the SIGABrasil XLS file `filename` 
+    (str) is cached (see `load_sigabrasil_file`)
+    and return the path (str) to the cache file.
+    """
+    
+    name = os.path.splitext(os.path.basename(filename))[0]
+    loader = lambda: read_sigabrasil_file(filename, drop_month_0)
+    cache_file = xca.cached_file(loader, [filename], sigabrasil_cache_dir(filename, cache_dir), name, extra=drop_month_0, content=content_hash)
+    
+    return cache_file
+
+
+def load_sigabrasil_file(filename, drop_month_0=True, use_cache=True, cache_dir=None, content_hash=False, categorical=False):
+    """
+    Load SIGABrasil data stored in a XLS file.
+    
+    The data is supposed to be obtained from 
+    the Painel Especialista in SIGA Brasil 
+    website.
+    
+    If `use_cache` is True, the data is converted 
+    to a columnar file in `cache_dir` (str or None,
+    defaults to a '.cache' directory next to 
+    `filename`) on the first read and loaded from
+    there afterwards, skipping the Excel parsing. 
+    The cache is invalidated when the file's 
+    modification time or size changes or, if 
+    `content_hash` is True, when its contents
+    change.
+    
+    If `categorical` is True, convert text columns
+    with low cardinality (e.g. Função, Ação, GND and
+    UG names) to categorical, which takes much less
+    memory and speeds up groupbys.
+    """
+    
+    def loader():
+        return read_sigabrasil_file(filename, drop_month_0)
+    
+    if not use_cache:
+        siga = loader()
+    else:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        siga = xca.cached_frame(loader, [filename], sigabrasil_cache_dir(filename, cache_dir), name, extra=drop_month_0, content=content_hash)
+    
+    if categorical:
+        siga, _ = xd.categorize_text_cols(siga)
+    
+    return siga
+
+
+def load_sigabrasil(file_pattern, drop_month_0=True, use_cache=True, cache_dir=None, n_jobs=None, categorical=False):
     """
     Load SIGABrasil data stored in multiple XLS
     files, following the glob pattern `file_pattern`
-    (str).
+    (str). See `load_sigabrasil_file` for the cache
+    parameters.
+    
+    If `n_jobs` (int or None) is greater than 1 
+    (or -1, for all CPUs), parse the files in that 
+    many worker processes. When using the cache, 
+    the workers only return the path to the cache
+    files, which are then read by the main process,
+    so no DataFrame is pickled between processes.
+    
+    If `categorical` is True, convert low-cardinality
+    text columns to categorical (see 
+    `load_sigabrasil_file`), with categories unified
+    across files so the concatenated columns remain
+    categorical.
     """
     
     file_list = sorted(glob(file_pattern))
-
-    siga = pd.concat([load_sigabrasil_file(filename, drop_month_0) for filename in file_list], ignore_index=True)
+    
+    # Sequential load:
+    if n_jobs is None or n_jobs == 1:
+        df_list = [load_sigabrasil_file(filename, drop_month_0, use_cache, cache_dir) for filename in file_list]
+    # Parallel load, through the cache:
+    elif use_cache:
+        cache_files = parallel_map(cache_sigabrasil_file, [(filename, drop_month_0, cache_dir) for filename in file_list], n_jobs, 'process')
+        df_list = [xca.read_frame(cache_file) for cache_file in cache_files]
+    # Parallel load, pickling the results:
+    else:
+        df_list = parallel_map(read_sigabrasil_file, [(filename, drop_month_0) for filename in file_list], n_jobs, 'process')
+    
+    # Convert to categorical the columns with low cardinality in any file:
+    if categorical:
+        cat_cols = []
+        for df in df_list:
+            cat_cols += [col for col in xd.categorize_text_cols(df)[1] if col not in cat_cols]
+        df_list = [xd.categorize_text_cols(df, cols=[col for col in cat_cols if col in df.columns])[0] for df in df_list]
+        df_list = xd.unify_dtypes(df_list)
+    
+    siga = pd.concat(df_list, ignore_index=True)
 
     return siga
 
 
-def deflate_values(siga_df, ipca_df):
+def deflate_values(siga_df, ipca, ipca_ref=None):
     """
     Given a DataFrame `siga_df` with orçamento monthly 
     data from SIGA Brasil, add to it deflated columns 
-    according to monthly IPCA DataFrame `ipca_df`.
+    according to `ipca`, either a monthly IPCA DataFrame
+    (with columns 'mes' and 'ipca') or a 
+    `xavy.economy.Deflator`.
+    
+    The reference IPCA is `ipca_ref` (float) or, if 
+    None, the one of the most recent month in `siga_df`
+    that has IPCA data.
     
     Return the modified DataFrame.
     """
     
+    deflator = ipca if isinstance(ipca, xe.Deflator) else xe.Deflator(ipca)
+    
     # Add data column:
-    siga_df['data'] = pd.to_datetime(siga_df['Ano'].astype(str) + '-' + siga_df['Mês (Número) DES'].apply(lambda x: '{:02d}'.format(x)) + '-01')
+    codes = xe.month_codes(siga_df['Ano'], siga_df['Mês (Número) DES'])
+    siga_df['data'] = xe.month_code_dates(codes)
 
-    # Join IPCA:
-    n_siga_0 = len(siga_df)
-    siga_df = siga_df.join(ipca_df.set_index('mes'), how='left', on='data')
-    assert len(siga_df) == n_siga_0, 'Join increased the number of rows.'
+    # Look up IPCA:
+    ipca_values = deflator.ipca_at_codes(codes)
+    siga_df['ipca'] = ipca_values
 
     # Get columns with values:
-    value_cols = list(filter(lambda s: s.find('(R$)') != -1, siga_df.columns))
+    value_cols = list(filter(lambda s: s.find('(R$)') != -1 and s.find(' IPCA') == -1, siga_df.columns))
+    ipca_cols  = [col + ' IPCA' for col in value_cols]
 
     # Compute real values (corrected for inflation):
-    ipca_last = siga_df.loc[~siga_df['ipca'].isnull()].sort_values('data', ascending=False).iloc[0]['ipca']
-    for col in value_cols:
-        siga_df[col + ' IPCA'] = siga_df[col] / siga_df['ipca'] * ipca_last
+    has_ipca  = ~np.isnan(ipca_values)
+    assert has_ipca.any(), 'Nenhum mês do orçamento encontrado na base de IPCA.'
+    ipca_last = ipca_values[has_ipca][codes[has_ipca].argmax()] if ipca_ref is None else ipca_ref
+    deflated  = deflator.deflate_codes(codes, siga_df[value_cols].to_numpy(dtype=float), ipca_last)
+    siga_df[ipca_cols] = deflated
 
-    assert siga_df[[col + ' IPCA' for col in value_cols]].isna().sum().sum() == 0, 'Valores faltando nos R$ ajustados pelo IPCA: atualizar a base de IPCA ou extrapolar até a última data do orçamento'
+    assert not np.isnan(deflated).any(), 'Valores faltando nos R$ ajustados pelo IPCA: atualizar a base de IPCA ou extrapolar até a última data do orçamento'
 
     return siga_df
 
 
-def std_orgaos(siga_df):
+def load_orgaos_dicts(filename):
+    """
+    Load the dicts used by `std_orgaos` from the 
+    JSON file `filename` (str), containing an 
+    object with keys 'ministerio' (standardizing
+    dict for 'Órgão Superior (UG) DESP') and 
+    'orgao' (standardizing dict for 
+    'Órgão (UG) DESP').
+    
+    Returns two dicts.
+    """
+    with open(filename, encoding='utf-8') as f:
+        dicts = json.load(f)
+    
+    return dicts['ministerio'], dicts['orgao']
+
+
+def std_orgaos(siga_df, dicts_file=None):
     """
     Add columns to DataFrame `siga_df` of 
     orçamento federal extracted from SIGA Brasil
     containing standardized (and grouped) ministries
-    names according to hard-coded dicts.
-    """
-    
-    # Standardizing dict (órgãos superiores):
-    ministerio_dict = {
-        'MINIST.DA CIENCIA,TECNOL.,INOV.E COMUNICACOES':'MINISTERIO DA CIENCIA E TECNOLOGIA',
-        'MINISTERIO DA CIENCIA, TECNOLOGIA E INOVACAO': 'MINISTERIO DA CIENCIA E TECNOLOGIA',
-        'MINISTERIO DA CIENCIA, TECNOLOGIA E INOVACOES': 'MINISTERIO DA CIENCIA E TECNOLOGIA',
-        'MINISTERIO DA INTEGRACAO NACIONAL': 'MINISTERIO DO DESENVOLVIMENTO REGIONAL',
-        'MINISTERIO DA JUSTICA E CIDADANIA': 'MINISTERIO DA JUSTICA',
-        'MINISTERIO DA JUSTICA E SEGURANCA PUBLICA': 'MINISTERIO DA JUSTICA',
-        'MINIST. DO PLANEJAMENTO, DESENVOLV. E GESTAO': 'MINISTERIO DA ECONOMIA',
-        'MINISTERIO DO PLANEJAMENTO,ORCAMENTO E GESTAO': 'MINISTERIO DA ECONOMIA',
-        'MINISTERIO DA FAZENDA':'MINISTERIO DA ECONOMIA',
-        'MINISTERIO DO TRABALHO E EMPREGO':'MINISTERIO DA ECONOMIA',
-        'MINISTERIO DA PESCA E AQÜICULTURA':'MINISTERIO DA AGRICULTURA, PECUARIA E ABASTECIMENTO',
-        'MINIST. DA AGRICUL.,PECUARIA E ABASTECIMENTO':'MINISTERIO DA AGRICULTURA, PECUARIA E ABASTECIMENTO'
-    }
-    # Standardizing dict (órgão):
-    orgao_dict = {
-        'COMPANHIA DE DESENV. DO VALE DO SAO FRANCISCO':'CIA.DE DES.DOS VALES DO S.FRANC.E DO PARNAIBA',
-        'MINIST. DA AGRICUL.,PECUARIA E ABASTECIMENTO':'MINISTERIO DA AGRICULTURA, PECUARIA E ABASTECIMENTO',
-        'MINIST. DO PLANEJAMENTO, DESENVOLV. E GESTAO':'MINISTERIO DA ECONOMIA',
-        'MINISTERIO DO PLANEJAMENTO,ORCAMENTO E GESTAO': 'MINISTERIO DA ECONOMIA',
-        'MINIST.DA CIENCIA,TECNOL.,INOV.E COMUNICACOES':'MINISTERIO DA CIENCIA E TECNOLOGIA',
-        'MINISTERIO DA CIENCIA, TECNOLOGIA E INOVACAO':'MINISTERIO DA CIENCIA E TECNOLOGIA',
-        'MINISTERIO DA INTEGRACAO NACIONAL':'MINISTERIO DO DESENVOLVIMENTO REGIONAL',
-        'MINISTERIO DA FAZENDA':'MINISTERIO DA ECONOMIA',
-        'MINISTERIO DO TRABALHO E EMPREGO':'MINISTERIO DA ECONOMIA',
-        'MINISTERIO DA JUSTICA E CIDADANIA':'MINISTERIO DA JUSTICA',
-        'MINISTERIO DA JUSTICA E SEGURANCA PUBLICA':'MINISTERIO DA JUSTICA',
-        'MINISTERIO DA PESCA E AQÜICULTURA':'MINISTERIO DA AGRICULTURA, PECUARIA E ABASTECIMENTO'
-    }
+    names according to hard-coded dicts 
+    `ministerio_dict` and `orgao_dict` or to dicts 
+    loaded from JSON file `dicts_file` (str, see 
+    `load_orgaos_dicts`). 
+    
+    The translation is applied to the categories 
+    of the columns, i.e. once per distinct name, 
+    and the new columns are categorical.
+    """
+    
+    if dicts_file is None:
+        ministerios, orgaos = ministerio_dict, orgao_dict
+    else:
+        ministerios, orgaos = load_orgaos_dicts(dicts_file)
     
     # Standardize:
-    siga_df['Órgão Superior (UG) STD'] = siga_df['Órgão Superior (UG) DESP'].map(xu.translate_dict(ministerio_dict))
-    siga_df['Órgão (UG) STD'] = siga_df['Órgão (UG) DESP'].map(xu.translate_dict(orgao_dict))
+    siga_df['Órgão Superior (UG) STD'] = xd.translate_categories(siga_df['Órgão Superior (UG) DESP'], ministerios)
+    siga_df['Órgão (UG) STD'] = xd.translate_categories(siga_df['Órgão (UG) DESP'], orgaos)
     
     return siga_df
 
@@ -124,67 +276,55 @@ def project_ipca(ipca, final_date):
     Return a DataFrame that extrapolates 
     `ipca` (DataFrame containing months and
     IPCA in decreasing chronological order)
-    up to date `final_date`.
-    """
+    up to date `final_date`. 
     
-    # Compute the average IPCA fractional increase in the last 12 months:
-    avg_ipca = (ipca['ipca'] / ipca['ipca'].shift(-1)).iloc[:12].mean()
-    
-    # Build a monthly sampled dates, from last one in `ipca` up to `final_date`:
-    last_date = ipca['mes'].max()
-    dates = pd.date_range(last_date, final_date, freq='M') + pd.DateOffset(days=1)
-    
-    # Use avg. IPCA to extrapolate:
-    last_ipca = ipca.loc[ipca['mes'] == last_date, 'ipca'].iloc[0]
-    proj_ipca = last_ipca * pd.Series([avg_ipca] * len(dates)).cumprod()
-
-    # Build DataFrame:
-    proj_df = pd.DataFrame()
-    proj_df['mes'] = dates
-    proj_df['ipca'] = proj_ipca
-    proj_df = proj_df.sort_values('mes', ascending=False)
-    
-    return proj_df
+    Same as `xavy.economy.project_ipca`.
+    """
+    return xe.project_ipca(ipca, final_date)
 
 
 def complement_ipca(ipca, final_date):
     """
     Extend `ipca` (DataFrame) up to 
-    `final_date`.
-    """
-    # Get extrapolation for IPCA:
-    proj  = project_ipca(ipca, final_date)
-    # Concatenate to existing data:
-    compl = pd.concat([proj, ipca], ignore_index=True)
+    `final_date`. 
     
-    return compl
+    Same as `xavy.economy.complement_ipca`.
+    """
+    return xe.complement_ipca(ipca, final_date)
 
 
-def etl_sigabrasil(file_pattern, ipca_file, verbose=True):
+def etl_sigabrasil(file_pattern, ipca_file, verbose=True, store_dir=None):
     """
     Load SIGA Brasil orçamento data from glob pattern 
     `file_pattern` (str), deflate them using IPCA data 
     from `ipca_file` (str) and standardize órgão names.
+    
+    The IPCA table is shared with other callers through
+    `xavy.economy.load_deflator`.
+    
+    If `store_dir` (str) is provided, ingest the data
+    incrementally into the partitioned store in that 
+    directory (see `update_siga_store`) and return 
+    all the data in the store.
     """
     
+    # Incremental ingestion:
+    if store_dir is not None:
+        update_siga_store(file_pattern, ipca_file, store_dir, verbose=verbose)
+        return load_siga_store(store_dir)
+    
     # Load orçamento data:
     siga_df = load_sigabrasil(file_pattern)
 
     # Find the most recent month in the SIGA data:
-    last_entry = siga_df.sort_values(['Ano', 'Mês (Número) DES']).iloc[-1]
-    final_ipca_date = '{}-{:02d}-01'.format(last_entry['Ano'], last_entry['Mês (Número) DES'])
-
-    # Load IPCA:
-    ipca_df = xu.load_data_from_local_or_bigquery('SELECT * FROM `gabinete-compartilhado.bruto_gabinete_administrativo.ipca`', ipca_file)
-    ipca_df['mes'] = pd.to_datetime(ipca_df['mes'])
-    if verbose:
-        print('Last IPCA date: ', ipca_df['mes'].max().date())
+    last_code = xe.month_codes(siga_df['Ano'], siga_df['Mês (Número) DES']).max()
+    final_ipca_date = xe.month_code_dates([last_code])[0]
 
-    # Extrapolate IPCA:
-    ipca_df = complement_ipca(ipca_df, final_ipca_date)
+    # Load IPCA, extrapolated up to the last month:
+    deflator = xe.load_deflator(ipca_file, final_ipca_date, verbose)
 
     # Deflate SIGA values:
-    siga_df = deflate_values(siga_df, ipca_df)
+    siga_df = deflate_values(siga_df, deflator)
     
     # Standardize órgãos names:
     siga_df = std_orgaos(siga_df)
@@ -192,48 +332,461 @@ def etl_sigabrasil(file_pattern, ipca_file, verbose=True):
     return siga_df
 
 
+def siga_manifest_file(store_dir):
+    """
+    Return the path (str) to the JSON file 
+    describing the partitioned SIGA Brasil
+    store in `store_dir` (str).
+    """
+    return os.path.join(store_dir, 'manifest.json')
+
+
+def read_siga_manifest(store_dir):
+    """
+    Return the description (dict) of the 
+    partitioned SIGA Brasil store in `store_dir` 
+    (str), or an empty dict if there is none.
+    """
+    filename = siga_manifest_file(store_dir)
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_siga_manifest(store_dir, manifest):
+    """
+    Save the description `manifest` (dict) of
+    the partitioned SIGA Brasil store in 
+    `store_dir` (str).
+    """
+    filename = siga_manifest_file(store_dir)
+    with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def partition_hash(part_df):
+    """
+    Return a hash (str) of the contents of 
+    `part_df` (DataFrame), used to detect 
+    changes in a partition.
+    """
+    row_hashes = pd.util.hash_pandas_object(part_df, index=False).to_numpy()
+    key = '|'.join(map(str, part_df.columns)).encode('utf-8') + row_hashes.tobytes()
+    return hashlib.sha1(key).hexdigest()
+
+
+def update_store_ipca(store_dir, manifest, ipca_file, final_ipca_date, verbose=True):
+    """
+    Return the IPCA table (DataFrame) extrapolated 
+    up to `final_ipca_date` for the SIGA Brasil store
+    in `store_dir` (str), described by `manifest` 
+    (dict, updated in place).
+    
+    If `ipca_file` (str) did not change since the 
+    last update, only the months after the stored 
+    table are projected (see 
+    `xavy.economy.extend_complement_ipca`).
+    Otherwise, the table is rebuilt.
+    """
+    
+    local_file = cl.local_data_file(ipca_file)
+    signature = None if local_file is None else xca.files_signature([local_file])
+    stored = manifest.get('ipca_table')
+    
+    if signature is not None and signature == manifest.get('ipca_signature') and stored is not None:
+        ipca_df = xe.extend_complement_ipca(xca.read_frame(os.path.join(store_dir, stored)), xe.load_ipca(ipca_file, verbose), final_ipca_date)
+    else:
+        ipca_df = xe.load_extended_ipca(ipca_file, final_ipca_date, verbose)
+    
+    filename = xca.write_frame(ipca_df, os.path.join(store_dir, 'ipca' + xca.cache_extension()))
+    manifest['ipca_table'] = os.path.basename(filename)
+    manifest['ipca_signature'] = signature
+    
+    return ipca_df
+
+
+def update_siga_store(file_pattern, ipca_file, store_dir, drop_month_0=True, use_cache=True, n_jobs=None, verbose=True):
+    """
+    Ingest SIGA Brasil orçamento data from glob 
+    pattern `file_pattern` (str) into a store in
+    `store_dir` (str) partitioned by month (Ano 
+    and Mês).
+    
+    Only new partitions or the ones whose contents 
+    changed are deflated and written. Partitions 
+    not found in the files are kept, so new exports
+    (e.g. the current year) can be ingested alone. 
+    Stored partitions whose IPCA changed (e.g. months
+    previously extrapolated) are rescaled in place.
+    
+    All partitions are deflated to the IPCA of the 
+    store's first ingestion; `load_siga_store` 
+    rescales them to the most recent month.
+    
+    Returns the month codes (list of ints, see 
+    `xavy.economy.month_codes`) of the partitions 
+    written.
+    """
+    
+    os.makedirs(store_dir, exist_ok=True)
+    manifest   = read_siga_manifest(store_dir)
+    partitions = manifest.get('partitions', {})
+    
+    # Load orçamento data (each file is parsed once, see `load_sigabrasil_file`):
+    siga_df = load_sigabrasil(file_pattern, drop_month_0, use_cache, n_jobs=n_jobs)
+    codes   = xe.month_codes(siga_df['Ano'], siga_df['Mês (Número) DES'])
+    
+    # Update IPCA, extrapolated up to the last month in the store:
+    last_code = max([codes.max()] + [int(code) for code in partitions])
+    ipca_df   = update_store_ipca(store_dir, manifest, ipca_file, xe.month_code_dates([last_code])[0], verbose)
+    deflator  = xe.Deflator(ipca_df)
+    ipca_ref  = manifest.get('ipca_ref', deflator.ipca_at_codes([last_code])[0])
+    
+    # Split data into partitions:
+    order  = np.argsort(codes, kind='stable')
+    part_codes, starts = np.unique(codes[order], return_index=True)
+    bounds = np.append(starts, len(order))
+    
+    # Write new or changed partitions:
+    written = []
+    for i, code in enumerate(part_codes):
+        part_df = siga_df.iloc[order[bounds[i]:bounds[i + 1]]].reset_index(drop=True)
+        digest  = partition_hash(part_df)
+        ipca    = deflator.ipca_at_codes([code])[0]
+        info    = partitions.get(str(code))
+        if info is not None and info['hash'] == digest and info['ipca'] == ipca:
+            continue
+        
+        part_df  = deflate_values(part_df, deflator, ipca_ref)
+        filename = xca.write_frame(part_df, os.path.join(store_dir, 'siga_{}-{:02d}{}'.format(code // 12, code % 12 + 1, xca.cache_extension())))
+        if info is not None and info['file'] != os.path.basename(filename):
+            os.remove(os.path.join(store_dir, info['file']))
+        partitions[str(code)] = {'file': os.path.basename(filename), 'hash': digest, 'ipca': ipca}
+        written.append(int(code))
+    
+    # Rescale stored partitions whose IPCA changed:
+    for key, info in partitions.items():
+        ipca = deflator.ipca_at_codes([int(key)])[0]
+        if info['ipca'] != ipca:
+            filename = os.path.join(store_dir, info['file'])
+            part_df  = xca.read_frame(filename)
+            ipca_cols = [col for col in part_df.columns if col.find('(R$) IPCA') != -1]
+            part_df[ipca_cols] = part_df[ipca_cols] * (info['ipca'] / ipca)
+            part_df['ipca'] = ipca
+            xca.write_frame(part_df, filename)
+            info['ipca'] = ipca
+    
+    if verbose:
+        print('Wrote {} of {} partitions to {}.'.format(len(written), len(partitions), store_dir))
+    
+    # Save store description:
+    manifest['partitions'] = partitions
+    manifest['ipca_ref']   = ipca_ref
+    manifest['ipca_last']  = deflator.ipca_at_codes([last_code])[0]
+    write_siga_manifest(store_dir, manifest)
+    
+    return written
+
+
+def load_siga_store(store_dir, dicts_file=None):
+    """
+    Load all SIGA Brasil orçamento data in the
+    partitioned store in `store_dir` (str, see 
+    `update_siga_store`), sorted by month, with 
+    values deflated to the most recent month and 
+    standardized órgão names (see `std_orgaos`).
+    """
+    
+    manifest = read_siga_manifest(store_dir)
+    assert len(manifest.get('partitions', {})) > 0, 'No data found in store {}'.format(store_dir)
+    
+    # Load partitions:
+    keys    = sorted(manifest['partitions'], key=int)
+    df_list = [xca.read_frame(os.path.join(store_dir, manifest['partitions'][key]['file'])) for key in keys]
+    siga_df = pd.concat(xd.unify_dtypes(df_list), ignore_index=True)
+    
+    # Rescale to the IPCA of the most recent month:
+    ipca_cols = [col for col in siga_df.columns if col.find('(R$) IPCA') != -1]
+    siga_df[ipca_cols] = siga_df[ipca_cols] * (manifest['ipca_last'] / manifest['ipca_ref'])
+    
+    # Standardize órgãos names:
+    siga_df = std_orgaos(siga_df, dicts_file)
+    
+    return siga_df
+
+
+def isin_mask(series, values):
+    """
+    Return a boolean array marking the entries 
+    of `series` (Series) that are in `values` 
+    (list). If `series` is categorical, only its 
+    categories are compared to `values`.
+    """
+    
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        cat_mask = np.append(series.cat.categories.isin(values), False)
+        # Missing values have code -1, which maps to the last entry (False):
+        return cat_mask[series.cat.codes.to_numpy()]
+    
+    return series.isin(values).to_numpy()
+
 
-def remove_unwanted_siga_data(siga_df, keep_only_executado=True, remove_funcoes=True, remove_elemento_despesa=True, remove_gnd=True):
+def remove_unwanted_siga_data(siga_df, keep_only_executado=True, remove_funcoes=True, remove_elemento_despesa=True, remove_gnd=True, report=False):
     """
     Remove rows from SIGA Brasil DataFrame `siga_df`
     based on the specified requirements.
+    
+    All requirements are combined in a single mask,
+    applied once. If `report` is True, also return 
+    a DataFrame with the number of rows removed by 
+    each rule ('n_registros') and their total 
+    'Despesa Executada (R$) IPCA' ('valor_realizado').
+    Rows matching more than one rule are attributed
+    to the first one.
     """
     
-    # Start with the input data:
-    out_df = siga_df
+    rules = []
     
     # Only keep rows with info about despesas executadas:
     if keep_only_executado:
-        out_df = out_df.loc[out_df['Despesa Executada (R$) IPCA'] != 0]
+        rules.append(('despesa_nao_executada', (siga_df['Despesa Executada (R$) IPCA'] == 0).to_numpy()))
     
     # Remove expenses with previdência social:
     if remove_funcoes:
-        out_df = out_df.loc[~out_df['Função DESP'].isin(['PREVIDÊNCIA SOCIAL', 'ENCARGOS ESPECIAIS'])]
+        rules.append(('funcao', isin_mask(siga_df['Função DESP'], unwanted_funcoes)))
     
     # Remove expenses with court-mandated payments:
     if remove_elemento_despesa:
-        out_df = out_df.loc[~out_df['Elemento Despesa DESP'].isin(['SENTENCAS JUDICIAIS', 'AUXÍLIO FINANCEIRO A PESQUISADORES', 'AUXÍLIO FINANCEIRO A ESTUDANTES', 
-                                                                   'PREMIAÇÕES CULTURAIS, ARTÍSTICAS, CIENTÍFICAS, DESPORTIVAS E OUTRAS', 'PENSOES ESPECIAIS', 
-                                                                   'DEPOSITOS COMPULSORIOS', 'EQUALIZAÇÃO DE PREÇOS E TAXAS'])]
+        rules.append(('elemento_despesa', isin_mask(siga_df['Elemento Despesa DESP'], unwanted_elementos_despesa)))
     
     # Remove expenses with public servants:
     if remove_gnd:
-        out_df = out_df.loc[~out_df['GND DESP'].isin(['PESSOAL E ENCARGOS SOCIAIS', 'JUROS E ENCARGOS DA DIVIDA', 'RESERVA DE CONTINGENCIA', 'AMORTIZACAO DA DIVIDA'])]
-        
+        rules.append(('gnd', isin_mask(siga_df['GND DESP'], unwanted_gnds)))
+    
+    # Combine rules:
+    removed = np.zeros(len(siga_df), dtype=bool)
+    stats = []
+    for name, mask in rules:
+        new_removed = mask & ~removed
+        if report:
+            stats.append({'regra': name, 'n_registros': new_removed.sum(), 
+                          'valor_realizado': siga_df['Despesa Executada (R$) IPCA'].to_numpy()[new_removed].sum()})
+        removed |= mask
+    
+    out_df = siga_df.loc[~removed]
+    
+    if report:
+        return out_df, pd.DataFrame(stats, columns=['regra', 'n_registros', 'valor_realizado']).set_index('regra')
+    
     return out_df
 
 
+# Default dimensions of BudgetCube (only the ones present in the data are used; 
+# 'data' is rebuilt from 'Ano' and 'Mês (Número) DES' when needed):
+cube_dims = ['Ano', 'Mês (Número) DES', 'Órgão Superior (UG) STD', 'Órgão (UG) STD', 'Ação DESP', 'Função DESP', 'Subfunção DESP', 'GND DESP', 'Elemento Despesa DESP']
+
+
+class BudgetCube:
+    """
+    SIGA Brasil orçamento data pre-aggregated 
+    by a set of dimensions, which answers 
+    roll-ups and slices without going back to 
+    the original rows.
+    
+    The data is stored as one row per observed
+    combination of dimension values (a cell), 
+    with integer codes for each dimension, the 
+    number of original rows and the sums of the 
+    value columns.
+    
+    Parameters
+    ----------
+    siga_df : DataFrame
+        SIGA Brasil data, e.g. the output of 
+        `etl_sigabrasil`.
+    dims : list of str or None
+        Columns used as dimensions. If None, use 
+        the ones in `cube_dims` present in `siga_df`.
+    value_cols : list of str or None
+        Columns to sum. If None, use all columns 
+        with '(R$)' in their names.
+    """
+    
+    def __init__(self, siga_df, dims=None, value_cols=None):
+        
+        if dims is None:
+            dims = [col for col in cube_dims if col in siga_df.columns]
+        if value_cols is None:
+            value_cols = [col for col in siga_df.columns if col.find('(R$)') != -1]
+        self.dims = list(dims)
+        self.value_cols = list(value_cols)
+        
+        # Encode dimensions as integers (in sorted order of their labels):
+        row_codes = []
+        self.labels = []
+        for dim in self.dims:
+            try:
+                codes, labels = pd.factorize(siga_df[dim], sort=True, use_na_sentinel=False)
+            except TypeError:
+                codes, labels = pd.factorize(siga_df[dim], sort=False, use_na_sentinel=False)
+            row_codes.append(codes)
+            self.labels.append(pd.Index(labels, name=dim))
+        self.cards = np.array([len(labels) for labels in self.labels], dtype=np.int64)
+        
+        # Find cells:
+        row_codes = np.array(row_codes, dtype=np.int64).reshape(len(self.dims), len(siga_df)).T
+        row_keys  = self.cell_keys(row_codes, np.arange(len(self.dims)))
+        cell_keys, first, row_cell = np.unique(row_keys, return_index=True, return_inverse=True)
+        self.codes = row_codes[first]
+        
+        # Aggregate:
+        n_cells = len(cell_keys)
+        self.counts = np.bincount(row_cell, minlength=n_cells)
+        self.values = np.array([np.bincount(row_cell, weights=siga_df[col].to_numpy(dtype=float), minlength=n_cells) for col in self.value_cols]).T
+    
+    def cell_keys(self, codes, dim_idx):
+        """
+        Return one integer key per row of `codes`
+        (2D array of dimension codes) combining the 
+        codes of the dimensions at positions `dim_idx` 
+        (array of ints). The keys are in the same order
+        as the combined codes.
+        """
+        keys   = np.zeros(len(codes), dtype=np.int64)
+        n_keys = 1
+        for i in dim_idx:
+            # Renumber the observed keys before they overflow:
+            if n_keys * int(self.cards[i]) >= 2 ** 62:
+                keys, uniques = pd.factorize(keys, sort=True)
+                keys, n_keys  = keys.astype(np.int64), len(uniques)
+            keys    = keys * self.cards[i] + codes[:, i]
+            n_keys *= int(self.cards[i])
+        return keys
+    
+    def cell_mask(self, where=None):
+        """
+        Return a boolean array selecting the cells
+        that satisfy `where` (dict from dimension 
+        to a value or list of values, or None).
+        """
+        mask = np.ones(len(self.codes), dtype=bool)
+        if where is None:
+            return mask
+        
+        for dim, values in where.items():
+            i = self.dims.index(dim)
+            if not isinstance(values, (list, tuple, set, np.ndarray, pd.Index)):
+                values = [values]
+            selected = np.append(self.labels[i].isin(list(values)), False)
+            mask &= selected[self.codes[:, i]]
+        
+        return mask
+    
+    def rollup(self, by, value_col='Despesa Executada (R$) IPCA', where=None):
+        """
+        Aggregate the cube.
+        
+        Parameters
+        ----------
+        by : str or list of str
+            Dimensions to group by.
+        value_col : str or None
+            Value column to sum. If None, count the 
+            number of original rows instead.
+        where : dict or None
+            Only use cells whose dimension (key) has 
+            the given value or list of values.
+        
+        Returns
+        -------
+        series : Series
+            The aggregated values, with `by` as index
+            in sorted order.
+        """
+        
+        if type(by) == str:
+            by = [by]
+        dim_idx = np.array([self.dims.index(dim) for dim in by], dtype=np.int64)
+        
+        # Select cells and their values:
+        mask  = self.cell_mask(where)
+        codes = self.codes[mask]
+        if value_col is None:
+            weights = self.counts[mask]
+        else:
+            weights = self.values[mask, self.value_cols.index(value_col)]
+        
+        # Aggregate:
+        keys = self.cell_keys(codes, dim_idx)
+        group_keys, first, group_pos = np.unique(keys, return_index=True, return_inverse=True)
+        totals = np.bincount(group_pos, weights=weights, minlength=len(group_keys))
+        if value_col is None:
+            totals = totals.astype(np.int64)
+        
+        # Build index:
+        group_codes = codes[first]
+        arrays = [self.labels[i][group_codes[:, i]] for i in dim_idx]
+        index = arrays[0] if len(arrays) == 1 else pd.MultiIndex.from_arrays(arrays)
+        
+        return pd.Series(totals, index=index, name='n_registros' if value_col is None else value_col)
+    
+    def count_by_category(self, col, where=None):
+        """
+        Same as `count_by_category`, using the cube.
+        """
+        df = pd.DataFrame()
+        df['n_registros'] = self.rollup(col, None, where)
+        df['valor_realizado'] = self.rollup(col, 'Despesa Executada (R$) IPCA', where)
+        return df.sort_values('valor_realizado', ascending=False)
+    
+    def value_timeseries(self, groupby, vcol='Despesa Executada (R$) IPCA', drop_last=False, where=None):
+        """
+        Same as `value_timeseries`, using the cube.
+        If `groupby` is 'data' and it is not a 
+        dimension, it is built from 'Ano' and 
+        'Mês (Número) DES'.
+        """
+        if groupby == 'data' and 'data' not in self.dims:
+            series = self.rollup(['Ano', 'Mês (Número) DES'], vcol, where)
+            codes  = xe.month_codes(series.index.get_level_values(0), series.index.get_level_values(1))
+            series.index = pd.DatetimeIndex(xe.month_code_dates(codes), name='data')
+        else:
+            series = self.rollup(groupby, vcol, where)
+        if drop_last:
+            series = series.iloc[:-1]
+        return series
+    
+    def slice(self, where):
+        """
+        Return a new BudgetCube with only the cells
+        that satisfy `where` (dict, see `rollup`).
+        """
+        cube = BudgetCube.__new__(BudgetCube)
+        cube.__dict__.update(self.__dict__)
+        mask = self.cell_mask(where)
+        cube.codes  = self.codes[mask]
+        cube.counts = self.counts[mask]
+        cube.values = self.values[mask]
+        return cube
+
+
 def count_by_category(siga, col):
     """
     Return a dataframe with number of 
     entries and their aggregated value
     (realizado) for data grouped by 
-    `col`.
+    `col`. `siga` can be a DataFrame or
+    a BudgetCube.
     """
+    if isinstance(siga, BudgetCube):
+        return siga.count_by_category(col)
+    
     df = pd.DataFrame()
-    n = siga.groupby(col).size()
+    n = siga.groupby(col, observed=True).size()
     df['n_registros'] = n
-    v = siga.groupby(col)['Despesa Executada (R$) IPCA'].sum()
+    v = siga.groupby(col, observed=True)['Despesa Executada (R$) IPCA'].sum()
     df['valor_realizado'] = v
     return df.sort_values('valor_realizado', ascending=False)
 
@@ -246,18 +799,93 @@ def count_by_col_pos(df, pos):
     grouped by `df` column at 
     position `pos`.
     """
+    assert not isinstance(df, BudgetCube), 'Use `count_by_category` with a column name for BudgetCube.'
     return count_by_category(df, df.columns[pos])
 
 
+class ValorSampler:
+    """
+    Weighted sampler of instances from `df` 
+    (DataFrame) with weights given by `weight_col`
+    (str), which preprocesses the weights once.
+    Samples with replacement are drawn with a 
+    binary search on the cumulative weights; 
+    samples without replacement, with random keys
+    (Efraimidis-Spirakis), whose cost does not 
+    depend on how skewed the weights are. 
+    
+    If `abs_weight` is True, ignore negative 
+    values (i.e. give them zero weight). Otherwise,
+    use the absolute value of `weight_col` as weight
+    (to deal with negative values). 
+    
+    `random_state` (int, Generator or None) 
+    seeds the draws.
+    """
+    
+    def __init__(self, df, abs_weight=True, weight_col='Despesa Executada (R$) IPCA', random_state=None):
+        
+        if abs_weight:
+            weights = df[weight_col].clip(lower=0.0)
+        else:
+            weights = df[weight_col].abs()
+        weights = weights.fillna(0.0).to_numpy(dtype=float)
+        assert (weights > 0).any(), 'All weights are zero.'
+        
+        self.df = df
+        self.weights = weights
+        self.n_positive = (weights > 0).sum()
+        self.cum_weights = np.cumsum(weights)
+        self.rng = np.random.default_rng(random_state)
+    
+    def sample_positions(self, n_samples, replace=False):
+        """
+        Return an array of `n_samples` (int) row 
+        positions drawn with probability proportional
+        to their weights, with or without replacement
+        (`replace`, bool).
+        """
+        
+        total = self.cum_weights[-1]
+        if replace:
+            return np.searchsorted(self.cum_weights, self.rng.random(n_samples) * total, side='right')
+        
+        assert n_samples <= self.n_positive, 'Cannot take {} samples without replacement from {} instances with positive weights.'.format(n_samples, self.n_positive)
+        
+        # Take the rows with the smallest random keys (rows with zero weight get infinite keys):
+        with np.errstate(divide='ignore'):
+            keys = self.rng.exponential(size=len(self.weights)) / self.weights
+        positions = np.argpartition(keys, n_samples - 1)[:n_samples] if n_samples > 0 else np.zeros(0, dtype=np.int64)
+        
+        # Sort them in the order they would be drawn sequentially:
+        return positions[np.argsort(keys[positions])]
+    
+    def sample(self, n_samples=5, replace=False):
+        """
+        Return `n_samples` (int) rows of the data 
+        drawn with probability proportional to 
+        their weights, with or without replacement
+        (`replace`, bool).
+        """
+        return self.df.iloc[self.sample_positions(n_samples, replace)]
+
+
 def sample_by_valor(df, n_samples=5, abs_weight=True, weight_col='Despesa Executada (R$) IPCA'):
     """
     Sample instances from `df` using weights given 
-    by `weight_col`. If `abs_weight` is True, use 
-    the absolute value of `weight_col` as weight
-    (to deal with negative values). Otherwise, 
-    ignore negative values.
+    by `weight_col`. If `abs_weight` is True, 
+    ignore negative values (i.e. give them zero 
+    weight). Otherwise, use the absolute value of 
+    `weight_col` as weight (to deal with negative
+    values).
+    
+    `df` can also be a ValorSampler, which avoids
+    preprocessing the weights in repeated calls.
     """
     
+    if isinstance(df, ValorSampler):
+        return df.sample(n_samples)
+    
     if abs_weight:
         weights = df[weight_col].clip(lower=0.0)
     else:
@@ -277,10 +905,16 @@ def value_timeseries(df, groupby, vcol='Despesa Executada (R$) IPCA', drop_last=
     
     Return a series with `groupby` as index 
     and aggregated `vcol` as values.
+    
+    `df` can also be a BudgetCube, in which 
+    case the pre-aggregated values are used.
     """
     
+    if isinstance(df, BudgetCube):
+        return df.value_timeseries(groupby, vcol, drop_last)
+    
     # Aggregate values:
-    series = df.groupby(groupby)[vcol].sum()
+    series = df.groupby(groupby, observed=True)[vcol].sum()
 
     if drop_last:
         series = series.sort_index().iloc[:-1]
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions for caching DataFrames in local files with a typed,
+columnar format (Parquet when available, pickle otherwise).
+"""
+
+import os
+import json
+import hashlib
+from glob import glob
+from importlib.util import find_spec
+import pandas as pd
+
+
+def parquet_engine():
+    """
+    Return the name (str) of the installed Parquet
+    engine ('pyarrow' or 'fastparquet') or None if
+    none is installed.
+    """
+    for engine in ['pyarrow', 'fastparquet']:
+        if find_spec(engine) is not None:
+            return engine
+    return None
+
+
+def cache_extension():
+    """
+    Return the file extension (str) used for cached
+    DataFrames: '.parquet' if a Parquet engine is
+    installed and '.pkl' otherwise.
+    """
+    if parquet_engine() is None:
+        return '.pkl'
+    return '.parquet'
+
+
+def file_hash(filename, block_size=2 ** 20):
+    """
+    Return the SHA-1 hash (str) of the contents 
+    of `filename` (str), read in blocks of 
+    `block_size` (int) bytes.
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def files_signature(filenames, extra=None, content=False):
+    """
+    Return a hash (str) identifying the current
+    state of the files `filenames` (list of str),
+    based on their absolute paths, modification
+    times and sizes. If `content` (bool) is True,
+    use the hash of their contents instead of 
+    modification times, so touching or copying 
+    a file does not change its signature. `extra` 
+    (JSON-serializable) is included in the hash, 
+    and can be used to identify the processing 
+    applied to the files.
+    """
+
+    state = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        version = file_hash(filename) if content else stat.st_mtime_ns
+        state.append([os.path.abspath(filename), version, stat.st_size])
+
+    key = json.dumps({'files': state, 'extra': extra}, sort_keys=True, default=str)
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def cache_filename(cache_dir, name, signature):
+    """
+    Return the path (str) to the cache file in
+    `cache_dir` (str) for data called `name` (str)
+    in the state identified by `signature` (str).
+    """
+    return os.path.join(cache_dir, '{}_{}{}'.format(name, signature[:16], cache_extension()))
+
+
+def find_cache_file(cache_dir, name, signature):
+    """
+    Return the path (str) to an existing cache 
+    file in `cache_dir` (str) for data called 
+    `name` (str) in the state identified by 
+    `signature` (str), in any of the supported 
+    formats, or None if there is none.
+    """
+    base = os.path.join(cache_dir, '{}_{}'.format(name, signature[:16]))
+    for extension in ['.parquet', '.pkl']:
+        if os.path.isfile(base + extension):
+            return base + extension
+    return None
+
+
+def write_frame(df, filename, row_group_size=None):
+    """
+    Save `df` (DataFrame) to `filename` (str) in
+    the format given by its extension ('.parquet'
+    or '.pkl'), keeping its dtypes. The file is
+    written to a temporary path first, so an
+    interrupted write never leaves a corrupt file.
+    
+    Parquet files are split in row groups of 
+    `row_group_size` (int or None) rows, so 
+    filtered reads can skip groups that do not
+    match the filters. If `df` cannot be stored
+    as Parquet (e.g. it has columns with mixed 
+    types), save it as a pickle instead.
+    
+    Returns the path (str) to the saved file.
+    """
+
+    dirname = os.path.dirname(filename)
+    if dirname != '':
+        os.makedirs(dirname, exist_ok=True)
+
+    tmp_file = filename + '.tmp'
+    if filename.endswith('.parquet'):
+        engine = parquet_engine()
+        kwargs = {}
+        if row_group_size is not None:
+            kwargs = {'row_group_size': row_group_size} if engine == 'pyarrow' else {'row_group_offsets': row_group_size}
+        try:
+            df.to_parquet(tmp_file, engine=engine, index=False, **kwargs)
+        except (TypeError, ValueError):
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+            return write_frame(df, filename[:-len('.parquet')] + '.pkl')
+    else:
+        df.to_pickle(tmp_file, compression=None)
+    os.replace(tmp_file, filename)
+    
+    return filename
+
+
+def apply_filters(df, filters):
+    """
+    Return the rows of `df` (DataFrame) that 
+    satisfy all `filters` (list of tuples 
+    (column, operator, value)), where operator
+    is one of '==', '!=', '<', '<=', '>', '>=', 
+    'in' or 'not in'.
+    """
+    
+    operators = {'==': lambda s, v: s == v, '!=': lambda s, v: s != v, 
+                 '<':  lambda s, v: s < v,  '<=': lambda s, v: s <= v, 
+                 '>':  lambda s, v: s > v,  '>=': lambda s, v: s >= v,
+                 'in': lambda s, v: s.isin(v), 'not in': lambda s, v: ~s.isin(v)}
+    
+    mask = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        mask &= operators[op](df[col], value)
+    
+    return df.loc[mask]
+
+
+def read_frame(filename, columns=None, filters=None):
+    """
+    Load a DataFrame saved by `write_frame` from
+    `filename` (str). If `columns` (list of str)
+    is provided, only return those columns. If 
+    `filters` (list of tuples, see `apply_filters`)
+    is provided, only return the rows that satisfy 
+    them.
+    
+    From Parquet files, only the requested columns 
+    and the row groups that might satisfy the 
+    filters are read.
+    """
+    
+    # Columns needed to evaluate the filters:
+    read_cols = columns
+    if columns is not None and filters is not None:
+        read_cols = list(columns) + [f[0] for f in filters if f[0] not in columns]
+    
+    if filename.endswith('.parquet'):
+        df = pd.read_parquet(filename, engine=parquet_engine(), columns=read_cols, filters=filters)
+    else:
+        df = pd.read_pickle(filename, compression=None)
+    
+    if filters is not None:
+        df = apply_filters(df, filters).reset_index(drop=True)
+    if columns is not None:
+        df = df[columns]
+
+    return df
+
+
+def iter_frame(filename, chunk_size=100000, columns=None):
+    """
+    Read `filename` (str), saved by `write_frame` 
+    or a CSV file, in DataFrame chunks of at most 
+    `chunk_size` (int) rows, with only `columns` 
+    (list of str or None for all).
+    
+    Parquet and CSV files are streamed, so only one 
+    chunk is held in memory at a time; pickles are 
+    loaded at once and then split.
+    
+    Returns a generator of DataFrames.
+    """
+    
+    if filename.endswith('.csv'):
+        for chunk in pd.read_csv(filename, chunksize=chunk_size, usecols=columns):
+            yield chunk.reset_index(drop=True)
+    
+    elif filename.endswith('.parquet') and parquet_engine() == 'pyarrow':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(filename).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    
+    else:
+        if filename.endswith('.parquet'):
+            from fastparquet import ParquetFile
+            groups = ParquetFile(filename).iter_row_groups(columns=columns)
+        else:
+            groups = [read_frame(filename, columns)]
+        for group in groups:
+            for start in range(0, len(group), chunk_size):
+                yield group.iloc[start:start + chunk_size].reset_index(drop=True)
+
+
+def sidecar_filename(filename):
+    """
+    Return the path (str) to the JSON file with 
+    metadata about the cached file `filename` (str).
+    """
+    return filename + '.json'
+
+
+def write_sidecar(filename, info):
+    """
+    Save `info` (JSON-serializable dict) as the 
+    metadata of the cached file `filename` (str).
+    """
+    tmp_file = sidecar_filename(filename) + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(info, f, indent=1, default=str)
+    os.replace(tmp_file, sidecar_filename(filename))
+
+
+def read_sidecar(filename):
+    """
+    Return the metadata (dict) saved with 
+    `write_sidecar` for the cached file 
+    `filename` (str), or an empty dict if 
+    there is none.
+    """
+    if not os.path.isfile(sidecar_filename(filename)):
+        return {}
+    with open(sidecar_filename(filename)) as f:
+        return json.load(f)
+
+
+def remove_stale(cache_dir, name, keep):
+    """
+    Delete the files in `cache_dir` (str) cached
+    for `name` (str), except for `keep` (str).
+    """
+    pattern = '{}_{}.*'.format(name, '[0-9a-f]' * 16)
+    for filename in glob(os.path.join(cache_dir, pattern)):
+        if os.path.abspath(filename) != os.path.abspath(keep):
+            os.remove(filename)
+
+
+def cached_file(loader, filenames, cache_dir, name, extra=None, sort_by=None, row_group_size=None, content=False, verbose=False):
+    """
+    Make sure a DataFrame is cached and return 
+    the path (str) to the cache file. 
+    
+    If the cache for the current state of 
+    `filenames` does not exist, build the 
+    DataFrame with `loader`, sort it by 
+    `sort_by` (str, list of str or None) and
+    save it in row groups of `row_group_size`
+    (int or None) rows. Sorting by the columns 
+    used in filters makes filtered reads skip 
+    most row groups. See `cached_frame` for the
+    other parameters.
+    """
+
+    signature = files_signature(filenames, extra, content)
+    filename  = find_cache_file(cache_dir, name, signature)
+
+    # Cache miss:
+    if filename is None:
+        df = loader()
+        if sort_by is not None:
+            df = df.sort_values(sort_by, kind='stable', ignore_index=True)
+        filename = cache_filename(cache_dir, name, signature)
+        if verbose:
+            print('Saving data to cache {}...'.format(filename))
+        filename = write_frame(df, filename, row_group_size)
+        remove_stale(cache_dir, name, filename)
+
+    return filename
+
+
+def cached_frame(loader, filenames, cache_dir, name, extra=None, content=False, verbose=False):
+    """
+    Load a DataFrame from cache or build it and cache it.
+
+    Parameters
+    ----------
+    loader : callable
+        Function with no arguments that builds the
+        DataFrame from `filenames`.
+    filenames : list of str
+        Source files read by `loader`. The cache is
+        invalidated when any of them changes.
+    cache_dir : str
+        Directory where to store the cache.
+    name : str
+        Name identifying the data in the cache.
+    extra : JSON-serializable
+        Other parameters that affect the output of
+        `loader`.
+    content : bool
+        Whether to identify changes in `filenames`
+        by the hash of their contents (True) or by
+        their modification times (False).
+    verbose : bool
+        Whether to report cache hits and misses.
+
+    Returns
+    -------
+    df : DataFrame
+        The cached data, if the source files did not
+        change since it was cached, or the output
+        of `loader`.
+    """
+
+    signature = files_signature(filenames, extra, content)
+    filename  = find_cache_file(cache_dir, name, signature)
+
+    # Cache hit:
+    if filename is not None:
+        if verbose:
+            print('Loading data from cache {}...'.format(filename))
+        return read_frame(filename)
+
+    # Cache miss:
+    df = loader()
+    filename = cache_filename(cache_dir, name, signature)
+    if verbose:
+        print('Saving data to cache {}...'.format(filename))
+    filename = write_frame(df, filename)
+    remove_stale(cache_dir, name, filename)
+
+    return df
@@ -7,8 +7,14 @@ Created on Mon Sep 20 12:13:26 2021
 """
 
 import os
+import re
+import hashlib
+import sqlite3
+from datetime import datetime, timezone
+from importlib.util import find_spec
 import pandas as pd
-import csv
+
+import xavy.cache as xca
 
 
 def bigquery_to_pandas(query, project='gabinete-compartilhado', credentials_file='/home/skems/gabinete/projetos/keys-configs/gabinete-compartilhado.json'):
@@ -43,12 +49,437 @@ def bigquery_to_pandas(query, project='gabinete-compartilhado', credentials_file
     return pd.read_gbq(query, project_id=project, dialect='standard', credentials=credentials)
 
 
+class BigQuerySource:
+    """
+    Data source that runs queries in Google BigQuery
+    (see `bigquery_to_pandas`).
+    """
+    
+    def __init__(self, project='gabinete-compartilhado', credentials_file='/home/skems/gabinete/projetos/keys-configs/gabinete-compartilhado.json'):
+        self.project = project
+        self.credentials_file = credentials_file
+    
+    def query(self, query):
+        """
+        Run `query` (str) and return its results 
+        as a DataFrame.
+        """
+        return bigquery_to_pandas(query, self.project, self.credentials_file)
+    
+    def query_chunks(self, query, chunk_size=100000):
+        """
+        Run `query` (str) and return its results 
+        as a generator of DataFrames with at most
+        `chunk_size` (int) rows, downloaded one 
+        page at a time.
+        """
+        
+        import google.auth
+        from google.cloud import bigquery
+        
+        # Set authorization to access GBQ:
+        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = self.credentials_file
+        credentials, project = google.auth.default(scopes=['https://www.googleapis.com/auth/bigquery'])
+        client = bigquery.Client(project=self.project, credentials=credentials)
+        
+        rows = client.query(query).result(page_size=chunk_size)
+        for chunk in rows.to_dataframe_iterable():
+            yield chunk
+    
+    def __repr__(self):
+        return 'BigQuery'
+
+
+class LocalWarehouseSource:
+    """
+    Data source that runs the SQL queries written 
+    for BigQuery against local copies of the tables,
+    using DuckDB if installed or SQLite otherwise.
+    DuckDB reads Parquet and CSV tables directly from
+    the files, with filters and column selection 
+    pushed down to the scan; SQLite needs the tables
+    loaded in memory.
+    
+    A table referenced in the query as 
+    `project.dataset.table` is read from the file 
+    `data_dir`/dataset/table with extension '.parquet', 
+    '.pkl' or '.csv' (the first one found). Query 
+    results are cached in a typed columnar format 
+    (see `xavy.cache`) and only recomputed when the 
+    query or the table files change.
+    
+    Parameters
+    ----------
+    data_dir : str
+        Directory containing the tables.
+    cache_dir : str or None
+        Where to cache query results. If None, use
+        a '.cache' directory inside `data_dir`.
+    use_cache : bool
+        Whether to cache query results.
+    engine : str or None
+        'duckdb' or 'sqlite'. If None, use DuckDB 
+        if it is installed.
+    """
+    
+    def __init__(self, data_dir, cache_dir=None, use_cache=True, engine=None):
+        self.data_dir  = data_dir
+        self.cache_dir = os.path.join(data_dir, '.cache') if cache_dir is None else cache_dir
+        self.use_cache = use_cache
+        if engine is None:
+            engine = 'duckdb' if find_spec('duckdb') is not None else 'sqlite'
+        self.engine = engine
+    
+    def table_refs(self, query):
+        """
+        Return the tables (list of str) referenced 
+        in `query` (str) between backticks.
+        """
+        return list(dict.fromkeys(re.findall(r'`([^`]+)`', query)))
+    
+    def table_file(self, table_ref):
+        """
+        Return the path (str) to the local file 
+        with the table `table_ref` (str, e.g. 
+        'project.dataset.table').
+        """
+        base = os.path.join(self.data_dir, *table_ref.split('.')[-2:])
+        for extension in ['.parquet', '.pkl', '.csv']:
+            if os.path.isfile(base + extension):
+                return base + extension
+        raise Exception('Table {} not found in {}.'.format(table_ref, self.data_dir))
+    
+    def load_table(self, table_ref):
+        """
+        Load the table `table_ref` (str) as a DataFrame.
+        """
+        filename = self.table_file(table_ref)
+        if filename.endswith('.csv'):
+            return pd.read_csv(filename, low_memory=False)
+        return xca.read_frame(filename)
+    
+    def local_query(self, query):
+        """
+        Return `query` (str) with the table references
+        replaced by local names (str) and a dict from
+        those names to the table references.
+        """
+        tables = {}
+        for table_ref in self.table_refs(query):
+            alias = re.sub(r'\W', '_', table_ref)
+            tables[alias] = table_ref
+            query = query.replace('`{}`'.format(table_ref), alias)
+        return query, tables
+    
+    def connect(self, tables):
+        """
+        Return a connection to an in-memory database
+        of the local engine where `tables` (dict from
+        local names to table references) can be 
+        queried, and a list of DataFrames with the 
+        tables' dtypes (see `restore_dtypes`): the 
+        tables loaded in memory or, for files scanned
+        by DuckDB, empty frames with their schema.
+        
+        In DuckDB, Parquet and CSV tables are views 
+        over the files, so DuckDB scans them itself 
+        (reading only the columns and row groups 
+        needed by the query). In SQLite, all tables
+        are loaded and copied into the database.
+        """
+        loaded = []
+        if self.engine == 'duckdb':
+            import duckdb
+            con = duckdb.connect()
+            for alias, table_ref in tables.items():
+                filename = self.table_file(table_ref)
+                path = os.path.abspath(filename).replace("'", "''")
+                if filename.endswith('.parquet'):
+                    con.execute("CREATE VIEW {} AS SELECT * FROM read_parquet('{}')".format(alias, path))
+                    if xca.parquet_engine() == 'pyarrow':
+                        import pyarrow.parquet as pq
+                        loaded.append(pq.read_schema(filename).empty_table().to_pandas())
+                elif filename.endswith('.csv'):
+                    con.execute("CREATE VIEW {} AS SELECT * FROM read_csv_auto('{}')".format(alias, path))
+                else:
+                    loaded.append(self.load_table(table_ref))
+                    con.register(alias, loaded[-1])
+        else:
+            con = sqlite3.connect(':memory:')
+            for alias, table_ref in tables.items():
+                loaded.append(self.load_table(table_ref))
+                loaded[-1].to_sql(alias, con, index=False)
+        return con, loaded
+    
+    def run(self, query):
+        """
+        Run `query` (str) against the local tables,
+        without using the cache, and return its 
+        results as a DataFrame.
+        """
+        
+        # Load tables and run query:
+        query, tables = self.local_query(query)
+        con, loaded = self.connect(tables)
+        try:
+            if self.engine == 'duckdb':
+                df = con.execute(query).df()
+            else:
+                df = pd.read_sql_query(query, con)
+        finally:
+            con.close()
+        
+        return restore_dtypes(df, loaded)
+    
+    def query(self, query):
+        """
+        Run `query` (str) against the local tables
+        (see `run`), using the cached results if the
+        query and the tables did not change.
+        """
+        if not self.use_cache:
+            return self.run(query)
+        
+        filenames = [self.table_file(table_ref) for table_ref in self.table_refs(query)]
+        name = 'query_' + hashlib.sha1(query.encode('utf-8')).hexdigest()[:16]
+        
+        return xca.cached_frame(lambda: self.run(query), filenames, self.cache_dir, name, extra=[query, self.engine])
+    
+    def query_chunks(self, query, chunk_size=100000):
+        """
+        Run `query` (str) against the local tables
+        and return its results as a generator of 
+        DataFrames with at most `chunk_size` (int) 
+        rows. With DuckDB, the results are streamed 
+        from the scan of the table files, so neither
+        the tables nor the results are held in memory
+        (except what the query itself needs, e.g. for
+        sorting); with SQLite, the tables are loaded 
+        in memory. The connection is closed when the
+        generator is exhausted or discarded.
+        """
+        
+        # Load tables and run query:
+        query, tables = self.local_query(query)
+        con, loaded = self.connect(tables)
+        try:
+            if self.engine == 'duckdb':
+                chunks = (batch.to_pandas() for batch in con.execute(query).fetch_record_batch(chunk_size))
+            else:
+                chunks = pd.read_sql_query(query, con, chunksize=chunk_size)
+            
+            for chunk in chunks:
+                yield restore_dtypes(chunk, loaded)
+        finally:
+            con.close()
+    
+    def __repr__(self):
+        return 'local warehouse {}'.format(self.data_dir)
+
+
+class LocalFileSource:
+    """
+    Data source that ignores the queries and 
+    returns the data in a local file `filename` 
+    (str, saved by `xavy.cache.write_frame` or a 
+    CSV), e.g. a sample of the query results used
+    in tests.
+    """
+    
+    def __init__(self, filename):
+        self.filename = filename
+    
+    def query(self, query):
+        """
+        Return the data in the file as a DataFrame.
+        """
+        if self.filename.endswith('.csv'):
+            return pd.read_csv(self.filename, low_memory=False)
+        return xca.read_frame(self.filename)
+    
+    def query_chunks(self, query, chunk_size=100000):
+        """
+        Return the data in the file as a generator
+        of DataFrames with at most `chunk_size` (int)
+        rows (see `xavy.cache.iter_frame`).
+        """
+        return xca.iter_frame(self.filename, chunk_size)
+    
+    def __repr__(self):
+        return 'local file {}'.format(self.filename)
+
+
+def restore_dtypes(df, tables):
+    """
+    Cast the columns of `df` (DataFrame, the result
+    of a query) that also appear in `tables` (list 
+    of DataFrames) with datetime, boolean or 
+    categorical dtypes back to those dtypes, which 
+    are lost in SQLite (and categoricals, in DuckDB). 
+    """
+    
+    for table in tables:
+        for col, dtype in table.dtypes.items():
+            if col not in df.columns or df[col].dtype == dtype:
+                continue
+            if pd.api.types.is_datetime64_any_dtype(dtype):
+                df[col] = pd.to_datetime(df[col])
+            elif isinstance(dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype('category')
+            elif pd.api.types.is_bool_dtype(dtype) and df[col].notnull().all():
+                df[col] = df[col].astype(bool)
+    
+    return df
+
+
+# Data source used by `load_data_from_local_or_bigquery` when none is given:
+default_source = None
+
+
+def set_default_source(source):
+    """
+    Set the data source (e.g. a BigQuerySource or a
+    LocalWarehouseSource) used by default to run 
+    queries. If None, use BigQuery, unless the 
+    environment variable XAVY_WAREHOUSE_DIR is set,
+    in which case a LocalWarehouseSource over that 
+    directory is used.
+    """
+    global default_source
+    default_source = source
+
+
+def get_default_source(project='gabinete-compartilhado', credentials_file='/home/skems/gabinete/projetos/keys-configs/gabinete-compartilhado.json'):
+    """
+    Return the data source used by default to run
+    queries (see `set_default_source`).
+    """
+    if default_source is not None:
+        return default_source
+    if os.environ.get('XAVY_WAREHOUSE_DIR'):
+        return LocalWarehouseSource(os.environ['XAVY_WAREHOUSE_DIR'])
+    return BigQuerySource(project, credentials_file)
+
+
+def snapshot_filename(filename):
+    """
+    Return the path (str) to the typed columnar
+    snapshot (see `xavy.cache.write_frame`) used 
+    to store the data of `filename` (str), e.g. 
+    'ipca.parquet' for 'ipca.csv'.
+    """
+    base, extension = os.path.splitext(filename)
+    if extension in ['.parquet', '.pkl']:
+        return filename
+    return base + xca.cache_extension()
+
+
+def find_snapshot(filename):
+    """
+    Return the path (str) to an existing snapshot 
+    of the data of `filename` (str), in any of the
+    supported formats, or None if there is none.
+    """
+    base, extension = os.path.splitext(filename)
+    candidates = [filename] if extension in ['.parquet', '.pkl'] else [base + '.parquet', base + '.pkl']
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def csv_stamp(filename):
+    """
+    Return the modification time (float) and size 
+    (int) of the file `filename` (str), used to tell
+    whether it changed after being converted to a 
+    snapshot.
+    """
+    stat = os.stat(filename)
+    return {'csv_mtime': stat.st_mtime, 'csv_size': stat.st_size}
+
+
+def is_stale_snapshot(snapshot, filename):
+    """
+    Return True if the old CSV file `filename` (str)
+    exists and changed after its data was saved to 
+    `snapshot` (str), i.e. if its modification time
+    or size differ from those recorded when it was 
+    converted or, if none were, if it is newer than
+    `snapshot`.
+    """
+    if snapshot == filename or not os.path.isfile(filename):
+        return False
+    sidecar = xca.read_sidecar(snapshot)
+    if 'csv_mtime' in sidecar:
+        stamp = csv_stamp(filename)
+        return stamp['csv_mtime'] != sidecar['csv_mtime'] or stamp['csv_size'] != sidecar.get('csv_size')
+    return os.path.getmtime(filename) > os.path.getmtime(snapshot)
+
+
+def migrate_csv(filename, query, low_memory=False):
+    """
+    Load the old CSV file `filename` (str) and save
+    its data as a snapshot, with a sidecar recording
+    the `query` (str) that produced it and the CSV's
+    modification time and size. Returns the data 
+    (DataFrame).
+    """
+    stamp = csv_stamp(filename)
+    df = pd.read_csv(filename, low_memory=low_memory)
+    print('Converting local file to {}...'.format(snapshot_filename(filename)))
+    snapshot = xca.write_frame(df, snapshot_filename(filename))
+    fetched_at = datetime.fromtimestamp(stamp['csv_mtime'], timezone.utc).isoformat()
+    xca.write_sidecar(snapshot, {'query': query, 'source': None, 'fetched_at': fetched_at, 'migrated_from': filename, **stamp})
+    return df
+
+
+def local_data_file(filename):
+    """
+    Return the path (str) to the local file 
+    holding the data of `filename` (str): its 
+    snapshot, if any and not older than the CSV
+    `filename`, or `filename` itself if it
+    exists. Otherwise, return None.
+    """
+    snapshot = find_snapshot(filename)
+    if snapshot is not None and not is_stale_snapshot(snapshot, filename):
+        return snapshot
+    if os.path.isfile(filename):
+        return filename
+    return None
+
+
+def save_snapshot(df, filename, query, source=None):
+    """
+    Save `df` (DataFrame) as a typed columnar 
+    snapshot of the data of `filename` (str), 
+    with a JSON sidecar recording the `query` 
+    (str) that produced it, the `source` it was
+    fetched from and the fetch time.
+    
+    Returns the path (str) to the snapshot.
+    """
+    snapshot = xca.write_frame(df, snapshot_filename(filename))
+    xca.write_sidecar(snapshot, {'query': query, 'source': None if source is None else str(source), 
+                                 'fetched_at': datetime.now(timezone.utc).isoformat()})
+    return snapshot
+
+
 def load_data_from_local_or_bigquery(query, filename, force_bigquery=False, save_data=True, 
                                      project='gabinete-compartilhado', 
                                      credentials_file='/home/skems/gabinete/projetos/keys-configs/gabinete-compartilhado.json',
-                                     low_memory=False):
+                                     low_memory=False, source=None, columns=None):
     """
     Loads data from local file if available or download it from BigQuery otherwise.
+    The query can also run in other data sources, like a local copy of the tables
+    (see `LocalWarehouseSource`).
+    
+    The data is stored locally as a typed columnar snapshot (Parquet if available,
+    pickle otherwise) next to `filename`, keeping its dtypes, with a JSON sidecar 
+    containing the query and the fetch time. CSV files saved by older versions 
+    are converted to snapshots on the first access, and again whenever they 
+    change (see `is_stale_snapshot`).
     
     
     Input
@@ -59,6 +490,9 @@ def load_data_from_local_or_bigquery(query, filename, force_bigquery=False, save
     
     filename : str
         The path to the file where to save the downloaded data and from where to load it.
+        The extension is replaced by the snapshot one (see `snapshot_filename`); a 
+        CSV file at `filename` is only read if there is no snapshot yet or if it
+        changed after being converted.
         
     force_bigquery : bool (default False)
         Whether to download data from BigQuery even if the local file exists.
@@ -75,6 +509,16 @@ def load_data_from_local_or_bigquery(query, filename, force_bigquery=False, save
     low_memory : bool (default False)
         Whether or not to avoid reading all the data to define the data types
         when loading data from a local file.
+    
+    source : data source or None (default None)
+        Object whose `query` method runs `query` and returns a DataFrame 
+        (e.g. a BigQuerySource or a LocalWarehouseSource). If None, use the 
+        default source (see `get_default_source`), which is BigQuery with 
+        `project` and `credentials_file` unless set otherwise.
+    
+    columns : list of str or None (default None)
+        Columns to return. When loading from a Parquet snapshot, only these
+        columns are read.
 
     Returns
     -------
@@ -83,17 +527,68 @@ def load_data_from_local_or_bigquery(query, filename, force_bigquery=False, save
         The data either loaded from `filename` or retrieved through `query`.
     """
     
+    snapshot = find_snapshot(filename)
+    
     # Download data from BigQuery and save it to local file:
-    if os.path.isfile(filename) == False or force_bigquery == True:
-        print('Loading data from BigQuery...')
-        df = bigquery_to_pandas(query, project, credentials_file)
+    if (snapshot is None and os.path.isfile(filename) == False) or force_bigquery == True:
+        if source is None:
+            source = get_default_source(project, credentials_file)
+        print('Loading data from {}...'.format(source))
+        df = source.query(query)
         if save_data:
             print('Saving data to local file...')
-            df.to_csv(filename, quoting=csv.QUOTE_ALL, index=False)
+            save_snapshot(df, filename, query, source)
+        if columns is not None:
+            df = df[columns]
+    
+    # Load data from local snapshot:
+    elif snapshot is not None and not is_stale_snapshot(snapshot, filename):
+        print('Loading data from local file...')
+        df = xca.read_frame(snapshot, columns)
     
-    # Load data from local file:
+    # Migrate old (or replaced) CSV file to snapshot:
     else:
+        if snapshot is not None:
+            print('Local file {} changed after conversion to {}.'.format(filename, snapshot))
         print('Loading data from local file...')
-        df = pd.read_csv(filename, low_memory=low_memory)
+        df = migrate_csv(filename, query, low_memory)
+        if columns is not None:
+            df = df[columns]
         
     return df
+
+
+def load_chunks_from_local_or_bigquery(query, filename, chunk_size=100000, force_bigquery=False,
+                                       project='gabinete-compartilhado', 
+                                       credentials_file='/home/skems/gabinete/projetos/keys-configs/gabinete-compartilhado.json',
+                                       source=None, columns=None):
+    """
+    Streaming version of `load_data_from_local_or_bigquery`: return
+    the data as a generator of DataFrames with at most `chunk_size` 
+    (int) rows, so it can be aggregated without holding all of it 
+    in memory.
+    
+    The data is read from the local snapshot of `filename` (or from
+    `filename` itself, if it is an old CSV file not converted yet or 
+    changed after conversion) if it exists and 
+    `force_bigquery` is False. Otherwise, it is downloaded through
+    `source` (see `load_data_from_local_or_bigquery`) one chunk at a
+    time, and not saved. Only `columns` (list of str or None for all)
+    are returned.
+    """
+    
+    local_file = local_data_file(filename)
+    
+    # Stream from data source:
+    if local_file is None or force_bigquery == True:
+        if source is None:
+            source = get_default_source(project, credentials_file)
+        print('Streaming data from {}...'.format(source))
+        for chunk in source.query_chunks(query, chunk_size):
+            yield chunk if columns is None else chunk[columns]
+    
+    # Stream from local file:
+    else:
+        print('Streaming data from local file...')
+        for chunk in xca.iter_frame(local_file, chunk_size, columns):
+            yield chunk
@@ -411,3 +411,113 @@ def str_join(df, delimiter=', '):
         series = series + delimiter + df[col]
     
     return series
+
+
+def unify_dtypes(df_list):
+    """
+    Cast the columns of DataFrames in `df_list` 
+    (list of DataFrames) to dtypes shared by all
+    of them, so they can be concatenated without
+    upcasting each piece along the way.
+    
+    Numerical columns get the smallest dtype that
+    holds all their versions (integers missing from
+    some DataFrames become floats, since they will
+    get NaNs); categorical columns get the union of
+    their categories, so they remain categorical 
+    after concatenation; other mixed columns become
+    object.
+    
+    Returns a list of DataFrames.
+    """
+    
+    # Gather dtypes of each column:
+    col_dtypes = {}
+    for df in df_list:
+        for col, dtype in df.dtypes.items():
+            col_dtypes.setdefault(col, []).append(dtype)
+    
+    # Find common dtypes:
+    common = {}
+    for col, dtypes in col_dtypes.items():
+        missing = len(dtypes) < len(df_list)
+        numeric = all(isinstance(d, np.dtype) and d.kind in 'iuf' for d in dtypes)
+        categorical = all(isinstance(d, pd.CategoricalDtype) for d in dtypes)
+        if numeric:
+            dtype = np.result_type(*dtypes)
+            if missing and dtype.kind in 'iu':
+                dtype = np.dtype(float)
+        elif categorical:
+            # Union of the categories, in order of appearance:
+            categories = pd.Index(np.concatenate([d.categories.to_numpy(dtype=object) for d in dtypes])).unique()
+            dtype = pd.CategoricalDtype(categories)
+        elif len(set(map(str, dtypes))) == 1:
+            dtype = dtypes[0]
+        else:
+            dtype = np.dtype(object)
+        if any(d != dtype for d in dtypes):
+            common[col] = dtype
+    
+    # Cast DataFrames:
+    unified = [df.astype({col: dtype for col, dtype in common.items() if col in df.columns}) for df in df_list]
+    
+    return unified
+
+
+def translate_categories(series, translator):
+    """
+    Translate the values in `series` (Series) 
+    according to `translator` (dict), keeping 
+    values not in `translator` as they are. 
+    
+    The translation is applied once per distinct
+    value, on the categories of `series` (which 
+    is converted to categorical if needed), so it
+    is fast for long series with few distinct 
+    values.
+    
+    Returns a categorical Series with the same
+    index as `series`.
+    """
+    
+    cat = series if isinstance(series.dtype, pd.CategoricalDtype) else series.astype('category')
+    
+    # Translate categories (different ones might be translated to the same value):
+    translated = [translator.get(c, c) for c in cat.cat.categories]
+    new_categories = pd.unique(np.array(translated, dtype=object))
+    # Keep categories sorted, like the values of a non-categorical series would be:
+    try:
+        new_categories = np.sort(new_categories)
+    except TypeError:
+        pass
+    new_pos = {c: i for i, c in enumerate(new_categories)}
+    code_map = np.array([new_pos[c] for c in translated] + [-1], dtype=np.int64)
+    
+    # Missing values have code -1, which maps to the last entry (-1):
+    codes = code_map[cat.cat.codes.to_numpy()]
+    result = pd.Series(pd.Categorical.from_codes(codes, categories=new_categories), index=series.index, name=series.name)
+    
+    return result
+
+
+def categorize_text_cols(df, max_frac=0.5, cols=None):
+    """
+    Convert the text columns of `df` (DataFrame)
+    whose number of distinct values is at most 
+    `max_frac` (float) times the number of rows
+    to categorical, in place. If `cols` (list of
+    str) is provided, convert those columns 
+    instead, regardless of their cardinality.
+    
+    Returns `df` and the list of converted columns.
+    """
+    
+    if cols is None:
+        text_cols = [col for col, dtype in df.dtypes.items() if dtype == object or (pd.api.types.is_string_dtype(dtype) and not isinstance(dtype, pd.CategoricalDtype))]
+        cols = [col for col in text_cols if df[col].nunique() <= max_frac * len(df)]
+    
+    for col in cols:
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    
+    return df, cols
@@ -6,6 +6,9 @@ Created on Mon Sep 20 12:18:01 2021
 @author: skems
 """
 
+import os
+import copy
+import numpy as np
 import pandas as pd
 import xavy.clouds as cl
 
@@ -24,62 +27,89 @@ def load_ipca(ipca_file, verbose=True):
     return ipca_df
 
 
-def project_ipca(ipca, final_date):
+def project_ipca(ipca, final_date, strategy='mean'):
     """
     Return a DataFrame that extrapolates 
     `ipca` (DataFrame containing months and
     IPCA in decreasing chronological order)
-    up to date `final_date`.
+    up to date `final_date`, with the monthly
+    increase rate given by `strategy` (see 
+    `IpcaModel`).
     """
     
-    # Compute the average IPCA fractional increase in the last 12 months:
-    avg_ipca = (ipca['ipca'] / ipca['ipca'].shift(-1)).iloc[:12].mean()
-    
-    # Build a monthly sampled dates, from last one in `ipca` up to `final_date`:
-    last_date = ipca['mes'].max()
-    dates = pd.date_range(last_date, final_date, freq='M') + pd.DateOffset(days=1)
+    # Extrapolate IPCA:
+    model = IpcaModel(ipca, final_date, strategy)
+    codes = np.arange(model.last_code, model.real_last_code, -1)
     
-    # Use avg. IPCA to extrapolate:
-    last_ipca = ipca.loc[ipca['mes'] == last_date, 'ipca'].iloc[0]
-    proj_ipca = last_ipca * pd.Series([avg_ipca] * len(dates)).cumprod()
-
-    # Build DataFrame:
+    # Build DataFrame (in decreasing chronological order):
     proj_df = pd.DataFrame()
-    proj_df['mes'] = dates
-    proj_df['ipca'] = proj_ipca
-    proj_df = proj_df.sort_values('mes', ascending=False)
+    proj_df['mes'] = month_code_dates(codes)
+    proj_df['ipca'] = model.ipca_at_codes(codes)
     
     return proj_df
 
 
-def complement_ipca(ipca, final_date):
+def complement_ipca(ipca, final_date, strategy='mean'):
     """
     Extend `ipca` (DataFrame) up to 
-    `final_date`.
+    `final_date`, with the monthly increase 
+    rate given by `strategy` (see `IpcaModel`).
     """
     # Get extrapolation for IPCA:
-    proj  = project_ipca(ipca, final_date)
+    proj  = project_ipca(ipca, final_date, strategy)
     # Concatenate to existing data:
     compl = pd.concat([proj, ipca], ignore_index=True)
     
     return compl
 
 
-def load_extended_ipca(ipca_file, final_ipca_date, verbose=True):
+def extend_complement_ipca(compl, ipca, final_date, strategy='mean'):
+    """
+    Extend `compl` (DataFrame), an output of 
+    `complement_ipca` for `ipca` (DataFrame) and
+    `strategy` (str or callable),
+    up to `final_date`, projecting only the
+    months after the last one in `compl` with 
+    the same increase rate. The result is the 
+    same as `complement_ipca(ipca, final_date)`,
+    without rebuilding the existing rows.
+    """
+    
+    last_date  = compl['mes'].max()
+    last_code  = date_month_codes([last_date])[0]
+    final_code = date_month_codes([final_date])[0]
+    if final_code <= last_code:
+        return compl
+    
+    # Continue the projection from the last month in `compl`:
+    avg_ipca  = IpcaModel(ipca, strategy=strategy).rate
+    last_ipca = compl.loc[compl['mes'] == last_date, 'ipca'].iloc[0]
+    steps     = np.arange(final_code - last_code, 0, -1)
+    
+    # Build DataFrame (in decreasing chronological order):
+    proj_df = pd.DataFrame()
+    proj_df['mes']  = month_code_dates(last_code + steps)
+    proj_df['ipca'] = last_ipca * avg_ipca ** steps
+    
+    return pd.concat([proj_df, compl], ignore_index=True)
+
+
+def load_extended_ipca(ipca_file, final_ipca_date, verbose=True, strategy='mean'):
     """
     Load IPCA data from `ipca_file` (str) as a DataFrame.
     If `ipca_file` does not exist, load it from BigQuery.
     If the last available date is less than `final_ipca_date`
     (str %Y-%m-%d or date-like object), extrapolate IPCA
-    up to `final_ipca_date` with the average increase rate
-    over the last 12 months.
+    up to `final_ipca_date` with the increase rate given by 
+    `strategy` (by default, the average increase rate over 
+    the last 12 months; see `IpcaModel`).
     """
     
     # Load IPCA:
     ipca_df = load_ipca(ipca_file, verbose)
     
     # Extrapolate IPCA:
-    ipca_df = complement_ipca(ipca_df, final_ipca_date)
+    ipca_df = complement_ipca(ipca_df, final_ipca_date, strategy)
 
     return ipca_df
 
@@ -93,50 +123,338 @@ def deflate_values(date_series, value_series, ipca_df, ref_date=None, suffix='_d
     date_series : Series
         A Pandas Series of dates (the day should always
         be the first).
-    value_series : Series
+    value_series : Series or DataFrame
         Values to be deflated by IPCA, aligned with the 
-        dates in `date_series`.
-    ipca_df : DataFrame
+        dates in `date_series`. All columns of a 
+        DataFrame are deflated at once.
+    ipca_df : DataFrame or Deflator
         DataFrame with columns 'mes' (datetime, where the
         day is always the first) and 'ipca' (the IPCA 
-        index for the corresponding month).
+        index for the corresponding month), or a 
+        Deflator (e.g. from `load_deflator`), which 
+        avoids rebuilding the IPCA lookup table.
     ref_date : str, datetime or None.
         Reference date (if str, in format %Y-%m-%d) for
         the deflated values. If None, use the last date
         in `ipca_df` as reference.
     suffix : str
-        A suffix for the returned Series.
+        A suffix for the returned Series name (or 
+        DataFrame columns).
         
     Returns
     -------
-    deflac_values : Series
-        A series with deflated version of values in 
-        `value_series` and name given by `value_series`
-        name + `suffix`.
+    deflac_values : Series or DataFrame
+        Deflated version of values in `value_series`,
+        with the same index and name (or column names) 
+        given by `value_series` name + `suffix`.
     """
     
     assert len(date_series) == len(value_series), '`date_series` and `value_series` should have the same length.'
     assert (date_series.index == value_series.index).all(), '`date_series` and `value_series` should have the same index.'
     
-    # Find reference IPCA:
-    if ref_date != None:
-        ref_ipca = ipca_df.loc[(ipca_df['mes'] == ref_date), 'ipca']
-        if len(ref_ipca) == 0:
-            raise Exception('{} not found in `ipca_df`.'.format(ref_date))
-        ref_ipca = ref_ipca.iloc[0]
-    # If no ref. date was provided, use the last one:
-    else:
-        ref_ipca = ipca_df.sort_values('mes', ascending=False)['ipca'].iloc[0]
-    assert ref_ipca != None, 'Reference IPCA is null.'
-    
-    # Join IPCA DataFrame to data:
-    df = pd.DataFrame({'mes': date_series, value_series.name: value_series})
-    assert len(df) == len(date_series), 'DataFrame of dates and values have more rows than input.'
-    df = df.merge(ipca_df, how='left', on='mes')
-    assert len(df) == len(date_series), 'Joining IPCA to input data led to a change in the number of rows'
-    
-    # Deflate values:
-    series = df[value_series.name] / df['ipca'] * ref_ipca
-    series.name = value_series.name + suffix
-    
-    return series
\ No newline at end of file
+    # Look up IPCA by month and deflate:
+    deflator = ipca_df if isinstance(ipca_df, Deflator) else Deflator(ipca_df)
+    deflac_values = deflator.deflate(date_series, value_series, ref_date, suffix)
+    
+    return deflac_values
+
+
+def month_codes(years, months):
+    """
+    Return integer codes (array) year * 12 + 
+    month - 1 for the given `years` (array-like
+    of ints) and `months` (array-like of ints 
+    from 1 to 12), which increase by one every
+    month.
+    """
+    return np.asarray(years, dtype=np.int64) * 12 + np.asarray(months, dtype=np.int64) - 1
+
+
+def date_month_codes(dates):
+    """
+    Return the month codes (array of ints, see
+    `month_codes`) of `dates` (date-like, str 
+    %Y-%m-%d or array-like of those).
+    """
+    dates = np.asarray(pd.to_datetime(dates), dtype='datetime64[ns]')
+    return dates.astype('datetime64[M]').astype(np.int64) + 1970 * 12
+
+
+def month_code_dates(codes):
+    """
+    Return the first day of each month (datetime64
+    array) represented by `codes` (array of ints,
+    see `month_codes`).
+    """
+    return (np.asarray(codes, dtype=np.int64) - 1970 * 12).astype('datetime64[M]').astype('datetime64[ns]')
+
+
+class Deflator:
+    """
+    Deflate monetary values with IPCA, using 
+    a month-indexed array of IPCA values built
+    once, so deflating is a lookup followed by 
+    a division.
+    
+    Parameters
+    ----------
+    ipca_df : DataFrame
+        DataFrame with columns 'mes' (datetime, where 
+        the day is always the first) and 'ipca' (the 
+        IPCA index for the corresponding month), e.g.
+        the output of `load_extended_ipca`.
+    """
+    
+    def __init__(self, ipca_df):
+        
+        codes = date_month_codes(ipca_df['mes'])
+        assert len(np.unique(codes)) == len(codes), '`ipca_df` has repeated months.'
+        
+        # Dense IPCA array indexed by month code:
+        self.first_code = codes.min()
+        self.last_code  = codes.max()
+        self.ipca_arr   = np.full(self.last_code - self.first_code + 1, np.nan)
+        self.ipca_arr[codes - self.first_code] = ipca_df['ipca'].to_numpy(dtype=float)
+        
+        # Reference IPCA:
+        self.last_ipca = self.ipca_arr[-1]
+    
+    def ipca_at_codes(self, codes):
+        """
+        Return the IPCA values (array) for month 
+        `codes` (array of ints, see `month_codes`), 
+        with NaN for months not in the table.
+        """
+        codes  = np.asarray(codes, dtype=np.int64)
+        pos    = codes - self.first_code
+        inside = (pos >= 0) & (pos < len(self.ipca_arr))
+        ipca   = np.full(codes.shape, np.nan)
+        ipca[inside] = self.ipca_arr[pos[inside]]
+        return ipca
+    
+    def ipca(self, dates):
+        """
+        Return the IPCA values (array) for `dates`
+        (array-like of date-like objects).
+        """
+        return self.ipca_at_codes(date_month_codes(dates))
+    
+    def ref_ipca(self, ref_date=None):
+        """
+        Return the IPCA value (float) at `ref_date` 
+        (str %Y-%m-%d, date-like or None). If None, 
+        return the last IPCA in the table.
+        """
+        if ref_date is None:
+            return self.last_ipca
+        
+        ref_ipca = self.ipca_at_codes(date_month_codes([ref_date]))[0]
+        if np.isnan(ref_ipca):
+            raise Exception('{} not found in IPCA table.'.format(ref_date))
+        return ref_ipca
+    
+    def deflate_codes(self, codes, values, ref_ipca):
+        """
+        Return `values` (array, 1D or 2D with one row 
+        per month code) for month `codes` (array of 
+        ints) deflated to the IPCA `ref_ipca` (float).
+        """
+        ipca = self.ipca_at_codes(codes)
+        if np.ndim(values) == 2:
+            ipca = ipca[:, None]
+        return values / ipca * ref_ipca
+    
+    def deflate(self, dates, values, ref_date=None, suffix=None):
+        """
+        Compute IPCA-corrected values.
+        
+        Parameters
+        ----------
+        dates : array-like
+            Dates of each value (or row of values). 
+        values : Series, DataFrame or array
+            Values to be deflated, aligned with `dates`.
+            A DataFrame or 2D array gets all its columns
+            deflated at once.
+        ref_date : str, datetime or None
+            Reference date (if str, in format %Y-%m-%d) 
+            for the deflated values. If None, use the 
+            last date in the IPCA table.
+        suffix : str or None
+            Suffix appended to the names of the 
+            returned Series or DataFrame columns.
+        
+        Returns
+        -------
+        deflated : Series, DataFrame or array
+            Same type and shape as `values`, with 
+            deflated values. Months missing from the 
+            IPCA table get NaN.
+        """
+        
+        assert len(dates) == len(values), '`dates` and `values` should have the same length.'
+        codes = date_month_codes(dates)
+        ref_ipca = self.ref_ipca(ref_date)
+        suffix = '' if suffix is None else suffix
+        
+        if isinstance(values, pd.DataFrame):
+            deflated = self.deflate_codes(codes, values.to_numpy(dtype=float), ref_ipca)
+            return pd.DataFrame(deflated, index=values.index, columns=[str(col) + suffix for col in values.columns])
+        
+        if isinstance(values, pd.Series):
+            deflated = self.deflate_codes(codes, values.to_numpy(dtype=float), ref_ipca)
+            name = None if values.name is None else str(values.name) + suffix
+            return pd.Series(deflated, index=values.index, name=name)
+        
+        return self.deflate_codes(codes, np.asarray(values, dtype=float), ref_ipca)
+
+
+def mean_rate(ipca_arr, n_months=12):
+    """
+    Return the average monthly IPCA fractional 
+    increase over the last `n_months` (int) of 
+    `ipca_arr` (array in chronological order).
+    """
+    ratios = ipca_arr[1:] / ipca_arr[:-1]
+    return np.nanmean(ratios[-n_months:])
+
+
+def geometric_rate(ipca_arr, n_months=12):
+    """
+    Return the geometric mean of the monthly IPCA 
+    fractional increases over the last `n_months` 
+    (int) of `ipca_arr` (array in chronological 
+    order).
+    """
+    ratios = ipca_arr[1:] / ipca_arr[:-1]
+    return np.exp(np.nanmean(np.log(ratios[-n_months:])))
+
+
+def last_value_rate(ipca_arr, n_months=12):
+    """
+    Return 1, i.e. keep the last IPCA value of
+    `ipca_arr` constant (`n_months` is ignored).
+    """
+    return 1.0
+
+
+# IPCA projection strategies, by name:
+projection_rates = {'mean': mean_rate, 'geometric': geometric_rate, 'last': last_value_rate}
+
+
+class IpcaModel(Deflator):
+    """
+    IPCA table with an extrapolation up to some
+    month, kept in a month-indexed array (see 
+    `Deflator`), so lookups of IPCA values and 
+    ratios take constant time.
+    
+    The months after the last one in the table are
+    projected as a power series of a constant 
+    monthly increase rate.
+    
+    Parameters
+    ----------
+    ipca_df : DataFrame
+        DataFrame with columns 'mes' (datetime, where 
+        the day is always the first) and 'ipca' (the 
+        IPCA index for the corresponding month), e.g.
+        the output of `load_ipca`.
+    final_date : str, datetime or None
+        Last month to extrapolate to (if str, in 
+        format %Y-%m-%d). If None, do not extrapolate.
+    strategy : str or callable
+        How to compute the monthly increase rate: 
+        'mean' (average of the last `n_months` 
+        increases), 'geometric' (their geometric mean),
+        'last' (keep the last IPCA constant) or a 
+        function of the IPCA array (in chronological 
+        order) and `n_months` that returns the rate.
+    n_months : int
+        Number of months used to compute the rate.
+    """
+    
+    def __init__(self, ipca_df, final_date=None, strategy='mean', n_months=12):
+        
+        super().__init__(ipca_df)
+        self.real_last_code = self.last_code
+        
+        # Monthly increase rate:
+        rate_func = projection_rates[strategy] if type(strategy) == str else strategy
+        self.rate = rate_func(self.ipca_arr, n_months)
+        
+        if final_date is not None:
+            extended = self.extend(final_date)
+            self.ipca_arr, self.last_code, self.last_ipca = extended.ipca_arr, extended.last_code, extended.last_ipca
+    
+    def extend(self, final_date):
+        """
+        Return a new IpcaModel with IPCA extrapolated
+        up to `final_date` (str %Y-%m-%d or date-like),
+        computing only the months not projected yet.
+        
+        This model is not changed, since it might be
+        shared with other callers (see `load_deflator`).
+        """
+        
+        final_code = date_month_codes([final_date])[0]
+        if final_code <= self.last_code:
+            return self
+        
+        # Power series from the last real IPCA:
+        steps = np.arange(self.last_code + 1, final_code + 1) - self.real_last_code
+        real_last_ipca = self.ipca_arr[self.real_last_code - self.first_code]
+        
+        model = copy.copy(self)
+        model.ipca_arr  = np.concatenate([self.ipca_arr, real_last_ipca * self.rate ** steps])
+        model.last_code = final_code
+        model.last_ipca = model.ipca_arr[-1]
+        
+        return model
+    
+    def index_at(self, month):
+        """
+        Return the IPCA value (float or array) at 
+        `month` (date-like, str %Y-%m-%d or array-like
+        of those), with NaN for months outside the 
+        table.
+        """
+        ipca = self.ipca(np.atleast_1d(month))
+        return ipca if np.ndim(month) > 0 else ipca[0]
+    
+    def ratio(self, month, ref=None):
+        """
+        Return the factor (float or array) that 
+        converts values at `month` (date-like, str
+        %Y-%m-%d or array-like of those) to values 
+        at `ref` (date-like, str or None for the 
+        last month in the table).
+        """
+        return self.ref_ipca(ref) / self.index_at(month)
+
+
+# Deflators already built, by IPCA file state and final date:
+loaded_deflators = {}
+
+
+def load_deflator(ipca_file, final_ipca_date, verbose=True, strategy='mean'):
+    """
+    Return an IpcaModel (a Deflator) built from 
+    the IPCA data in `ipca_file` extrapolated up
+    to `final_ipca_date` with `strategy` (see 
+    `load_extended_ipca`). The model is kept in 
+    memory and reused in later calls with the same 
+    arguments, unless `ipca_file` changed, so it 
+    should not be modified (`IpcaModel.extend` 
+    returns a new model).
+    """
+    
+    local_file = cl.local_data_file(ipca_file)
+    mtime = None if local_file is None else os.path.getmtime(local_file)
+    key = (os.path.abspath(ipca_file), mtime, str(pd.to_datetime(final_ipca_date).date()), strategy)
+    
+    if key not in loaded_deflators:
+        loaded_deflators[key] = IpcaModel(load_ipca(ipca_file, verbose), final_ipca_date, strategy)
+    
+    return loaded_deflators[key]
+
@@ -1,4 +1,7 @@
 import numpy as np
+import pandas as pd
+from multiprocessing import Pool, cpu_count
+from statistics import NormalDist
 
 def compute_correlation(a, b):
     """
@@ -8,31 +11,556 @@ def compute_correlation(a, b):
     return np.corrcoef(a, b)[0, 1]
 
 
-def bootstrap_correlation(series_a, series_b, n_trials=10000):
+def standardize(x):
+    """
+    Return `x` (array-like) as a float array
+    with zero mean and unit norm, so that the 
+    dot product between two standardized arrays 
+    is their Pearson correlation. If `x` is 2D,
+    standardize each column separately.
+    """
+    x = np.asarray(x, dtype=float)
+    x = x - x.mean(axis=0)
+    
+    return x / np.sqrt((x ** 2).sum(axis=0))
+
+
+def default_chunk_size(n_instances, max_entries=2 ** 22):
+    """
+    Return the number of trials (int) to draw at 
+    once so that an index matrix for `n_instances` 
+    (int) instances has at most `max_entries` (int) 
+    entries.
+    """
+    return max(1, max_entries // max(1, n_instances))
+
+
+def permutation_chunks(n_instances, n_trials, chunk_size=None, random_state=None):
+    """
+    Generate random permutations of `n_instances`
+    (int) positions as integer index matrices.
+    
+    Parameters
+    ----------
+    n_instances : int
+        Number of entries being permuted.
+    n_trials : int
+        Total number of permutations to draw.
+    chunk_size : int or None
+        Maximum number of permutations (rows) in 
+        each matrix. If None, use `default_chunk_size`.
+    random_state : int, Generator or None
+        Seed or `numpy.random.Generator` used to 
+        draw the permutations. Set to `None` for a 
+        random seed.
+    
+    Yields
+    ------
+    indices : array of shape (chunk, `n_instances`)
+        Each row is one random permutation of 
+        range(`n_instances`).
+    """
+    rng = np.random.default_rng(random_state)
+    if chunk_size is None:
+        chunk_size = default_chunk_size(n_instances)
+    
+    base = np.arange(n_instances)
+    for start in range(0, n_trials, chunk_size):
+        n_rows = min(chunk_size, n_trials - start)
+        yield rng.permuted(np.tile(base, (n_rows, 1)), axis=1)
+
+
+def indexed_correlations(std_fixed, std_moved, indices, resampled=False):
+    """
+    Compute the Pearson correlations between 
+    `std_fixed` (standardized array) and rearranged
+    copies of `std_moved` (standardized array).
+    
+    Each row of `indices` (2D int array) selects one
+    rearrangement of `std_moved`. If `std_fixed` is
+    2D (instances x variables), return one column 
+    of correlations per variable. Set `resampled` 
+    (bool) to True if the rows of `indices` may 
+    repeat positions (i.e. they are not permutations),
+    so each rearranged copy is re-standardized;
+    copies with zero variance get NaN correlations.
+    """
+    moved = std_moved[indices]
+    
+    # Resampling with replacement changes the mean and norm of the moved array:
+    if resampled:
+        moved = moved - moved.mean(axis=1, keepdims=True)
+        norms = np.sqrt((moved ** 2).sum(axis=1))
+        norms[norms <= 1e-10 * np.sqrt(indices.shape[1])] = np.nan
+        corrs = moved @ std_fixed
+        corrs = corrs / (norms[:, None] if corrs.ndim == 2 else norms)
+    else:
+        corrs = moved @ std_fixed
+    
+    return corrs
+
+
+def iter_bootstrap_correlation(series_a, series_b, n_trials=10000, chunk_size=None, random_state=None):
+    """
+    Generate arrays of correlations computed 
+    from `series_a` (array-like) and `series_b` 
+    (array-like) when the second series is 
+    scrambled, adding up to `n_trials` (int) 
+    correlations. See `permutation_chunks` for 
+    `chunk_size` and `random_state`.
+    """
+    
+    assert len(series_a) == len(series_b)
+    n_instances = len(series_b)
+    
+    # Standardize once, so each correlation is a dot product:
+    std_a = standardize(series_a)
+    std_b = standardize(series_b)
+    
+    for indices in permutation_chunks(n_instances, n_trials, chunk_size, random_state):
+        yield indexed_correlations(std_a, std_b, indices)
+
+
+def bootstrap_correlation(series_a, series_b, n_trials=10000, chunk_size=None, random_state=None):
     """
     Return `n_trials` (int) correlations (array) 
     computed from `series_a` (Series) and `series_b` 
     (Series) when the second series is scrambled.
+    
+    The permutations are drawn in chunks of at 
+    most `chunk_size` (int or None) trials from 
+    a generator seeded by `random_state` (int, 
+    Generator or None).
+    """
+    
+    chunks = iter_bootstrap_correlation(series_a, series_b, n_trials, chunk_size, random_state)
+    corrs = np.concatenate(list(chunks)) if n_trials > 0 else np.array([])
+    
+    return corrs
+
+
+def moving_block_chunks(n_instances, n_trials, block_length, chunk_size=None, random_state=None):
+    """
+    Generate moving-block bootstrap resamplings of
+    `n_instances` (int) positions as integer index 
+    matrices, each row built by concatenating blocks 
+    of `block_length` (int) consecutive positions 
+    starting at random places. See `permutation_chunks`
+    for the other parameters.
+    """
+    rng = np.random.default_rng(random_state)
+    if chunk_size is None:
+        chunk_size = default_chunk_size(n_instances)
+    
+    block_length = int(min(max(1, round(block_length)), n_instances))
+    n_blocks = int(np.ceil(n_instances / block_length))
+    offsets  = np.arange(block_length)
+    for start in range(0, n_trials, chunk_size):
+        n_rows = min(chunk_size, n_trials - start)
+        starts = rng.integers(0, n_instances - block_length + 1, size=(n_rows, n_blocks))
+        indices = (starts[:, :, None] + offsets).reshape(n_rows, -1)
+        yield indices[:, :n_instances]
+
+
+def stationary_block_chunks(n_instances, n_trials, block_length, chunk_size=None, random_state=None):
+    """
+    Generate stationary bootstrap resamplings 
+    (Politis & Romano, 1994) of `n_instances` (int) 
+    positions as integer index matrices. Each row 
+    is made of blocks of consecutive positions 
+    (wrapping around the end) with random starts 
+    and geometrically distributed lengths of mean
+    `block_length` (float). See `permutation_chunks`
+    for the other parameters.
+    """
+    rng = np.random.default_rng(random_state)
+    if chunk_size is None:
+        chunk_size = default_chunk_size(n_instances)
+    
+    p_new_block = 1 / min(max(1.0, block_length), n_instances)
+    positions = np.arange(n_instances)
+    for start in range(0, n_trials, chunk_size):
+        n_rows = min(chunk_size, n_trials - start)
+        # Mark where blocks start and find, for each position, the start of its block:
+        new_block = rng.random((n_rows, n_instances)) < p_new_block
+        new_block[:, 0] = True
+        block_pos = np.maximum.accumulate(np.where(new_block, positions, 0), axis=1)
+        # Each block starts at a random place and then runs forward:
+        block_starts = rng.integers(0, n_instances, size=(n_rows, n_instances))
+        first = np.take_along_axis(block_starts, block_pos, axis=1)
+        yield (first + positions - block_pos) % n_instances
+
+
+def flat_top_kernel(t):
+    """
+    Trapezoidal flat-top kernel used in the 
+    automatic block length selection, evaluated 
+    at `t` (array-like).
+    """
+    t = np.abs(np.asarray(t, dtype=float))
+    return np.where(t <= 0.5, 1.0, np.where(t <= 1.0, 2 * (1 - t), 0.0))
+
+
+def optimal_block_length(series, method='stationary'):
+    """
+    Estimate the optimal block length for the 
+    block bootstrap of `series` (array-like).
+    
+    Use the method of Politis & White (2004), 
+    with the correction of Patton, Politis & 
+    White (2009).
+    
+    Parameters
+    ----------
+    series : array-like
+        Time series (ordered in time) to be resampled.
+    method : str
+        Either 'stationary' (average block length for
+        the stationary bootstrap) or 'moving' (block 
+        length for the moving-block bootstrap).
+    
+    Returns
+    -------
+    block_length : float
+        The estimated block length, between 1 and
+        the maximum allowed for the series length.
+    """
+    
+    x = np.asarray(series, dtype=float)
+    x = x - x.mean()
+    n_instances = len(x)
+    
+    # Parameters recommended by Politis & White:
+    k_n     = max(5, int(np.ceil(np.log10(n_instances))))
+    max_lag = min(int(np.ceil(np.sqrt(n_instances))) + k_n, n_instances - 1)
+    max_len = np.ceil(min(3 * np.sqrt(n_instances), n_instances / 3))
+    threshold = 2 * np.sqrt(np.log10(n_instances) / n_instances)
+    
+    # Autocovariances and autocorrelations:
+    acov = np.array([(x[:n_instances - k] * x[k:]).sum() / n_instances for k in range(max_lag + 1)])
+    if acov[0] == 0:
+        return 1.0
+    acorr = np.abs(acov[1:] / acov[0])
+    
+    # Find the first lag followed by `k_n` insignificant autocorrelations:
+    m_hat = max_lag
+    n_small = 0
+    for lag, rho in enumerate(acorr, start=1):
+        n_small = n_small + 1 if rho < threshold else 0
+        if n_small == k_n:
+            m_hat = lag - k_n
+            break
+    m = min(2 * max(m_hat, 1), max_lag)
+    
+    # Spectral quantities:
+    lags    = np.arange(-m, m + 1)
+    weights = flat_top_kernel(lags / m) * acov[np.abs(lags)]
+    g_hat   = (weights * np.abs(lags)).sum()
+    spec_0  = weights.sum()
+    if method == 'stationary':
+        d_hat = 2 * spec_0 ** 2
+    elif method == 'moving':
+        d_hat = 4 / 3 * spec_0 ** 2
+    else:
+        raise ValueError("`method` should be 'stationary' or 'moving'.")
+    if d_hat == 0:
+        return 1.0
+    
+    block_length = (2 * g_hat ** 2 / d_hat) ** (1 / 3) * n_instances ** (1 / 3)
+    
+    return float(min(max(block_length, 1.0), max_len))
+
+
+def iter_block_bootstrap_correlation(series_a, series_b, n_trials=10000, method='stationary', block_length=None, chunk_size=None, random_state=None):
+    """
+    Generate arrays of correlations computed from 
+    `series_a` (array-like) and block bootstrap 
+    resamplings of `series_b` (array-like), adding 
+    up to `n_trials` (int) correlations. See 
+    `block_bootstrap_correlation` for the other 
+    parameters.
     """
     
     assert len(series_a) == len(series_b)
     n_instances = len(series_b)
     
-    corrs = np.array([compute_correlation(series_a, series_b.sample(n_instances)) for _ in range(n_trials)])
+    # Select the block length:
+    if block_length is None:
+        block_length = max(optimal_block_length(series_a, method), optimal_block_length(series_b, method))
+    
+    # Select resampling scheme:
+    if method == 'stationary':
+        chunks = stationary_block_chunks(n_instances, n_trials, block_length, chunk_size, random_state)
+    elif method == 'moving':
+        chunks = moving_block_chunks(n_instances, n_trials, block_length, chunk_size, random_state)
+    else:
+        raise ValueError("`method` should be 'stationary' or 'moving'.")
+    
+    # Standardize once, so each correlation is a dot product:
+    std_a = standardize(series_a)
+    std_b = standardize(series_b)
+    
+    for indices in chunks:
+        yield indexed_correlations(std_a, std_b, indices, resampled=True)
+
+
+def block_bootstrap_correlation(series_a, series_b, n_trials=10000, method='stationary', block_length=None, chunk_size=None, random_state=None):
+    """
+    Return `n_trials` (int) correlations (array)
+    computed from `series_a` (Series) and block 
+    bootstrap resamplings of `series_b` (Series).
+    
+    Resampling blocks of consecutive entries 
+    keeps the autocorrelation of `series_b` 
+    while breaking its alignment with `series_a`, 
+    which is more appropriate than scrambling 
+    (see `bootstrap_correlation`) for time series.
+    
+    Parameters
+    ----------
+    series_a : Series or array-like
+        Time series kept fixed.
+    series_b : Series or array-like
+        Time series resampled in blocks, with the 
+        same length as `series_a`.
+    n_trials : int
+        Number of resamplings.
+    method : str
+        Either 'stationary' (blocks of random 
+        geometrically distributed lengths, wrapping
+        around the end) or 'moving' (blocks of fixed
+        length).
+    block_length : float or None
+        The (average, for 'stationary') block length.
+        If None, use the largest `optimal_block_length`
+        of the two series.
+    chunk_size : int or None
+        Number of resamplings drawn at once. If None,
+        use `default_chunk_size`.
+    random_state : int, Generator or None
+        Seed or `numpy.random.Generator` used to 
+        draw the blocks.
+    
+    Returns
+    -------
+    corrs : array
+        The correlations for each resampling (NaN
+        for resamplings with zero variance, which 
+        `p_value` ignores).
+    """
+    
+    chunks = iter_block_bootstrap_correlation(series_a, series_b, n_trials, method, block_length, chunk_size, random_state)
+    corrs = np.concatenate(list(chunks)) if n_trials > 0 else np.array([])
     
     return corrs
 
 
-def p_value(trials, threshold):
+def correlation_matrix_chunk(std_predictors, std_target, n_trials, seed):
+    """
+    Return an array (`n_trials` x predictors) of
+    correlations between the columns of 
+    `std_predictors` (standardized 2D array) and 
+    `n_trials` (int) permutations of `std_target`
+    (standardized array) drawn with `seed` (int or 
+    SeedSequence).
+    """
+    indices = next(permutation_chunks(len(std_target), n_trials, n_trials, seed))
+    return indexed_correlations(std_predictors, std_target, indices)
+
+
+def bootstrap_correlation_matrix(predictors, target, n_trials=10000, chunk_size=None, random_state=None, n_jobs=None, two_sided=False):
+    """
+    Run a permutation test for the correlation 
+    between each column in `predictors` and 
+    `target`, sharing the same permutations of 
+    `target` across all columns.
+    
+    Parameters
+    ----------
+    predictors : DataFrame
+        Variables whose correlation with `target`
+        will be tested (one per column).
+    target : Series or array-like
+        Variable that gets scrambled, aligned with
+        `predictors` rows.
+    n_trials : int
+        Number of permutations of `target`.
+    chunk_size : int or None
+        Number of permutations computed at once.
+        If None, use `default_chunk_size`.
+    random_state : int or None
+        Seed for the permutations. Chunks get 
+        independent seeds spawned from it, so the
+        result does not depend on `n_jobs`.
+    n_jobs : int or None
+        Number of processes used to compute the 
+        chunks. If -1, use all CPUs; if None, run
+        in the current process.
+    two_sided : bool
+        If True, compute p-values from the absolute
+        values of the correlations. Otherwise, compute 
+        right-side p-values (see `p_value`).
+    
+    Returns
+    -------
+    null_df : DataFrame
+        The `n_trials` correlations (rows) obtained 
+        for each column in `predictors` when `target`
+        is scrambled.
+    p_values : Series
+        The p-value of the observed correlation of 
+        each column in `predictors`.
+    """
+    
+    assert len(predictors) == len(target), '`predictors` and `target` should have the same length.'
+    n_instances = len(target)
+    
+    # Standardize once, so each chunk is a single matrix product:
+    std_predictors = standardize(predictors)
+    std_target     = standardize(target)
+    
+    # Split trials in chunks with independent seeds:
+    if chunk_size is None:
+        chunk_size = default_chunk_size(n_instances)
+    sizes = [min(chunk_size, n_trials - start) for start in range(0, n_trials, chunk_size)]
+    seeds = np.random.SeedSequence(random_state).spawn(len(sizes))
+    tasks = [(std_predictors, std_target, size, seed) for size, seed in zip(sizes, seeds)]
+    
+    # Compute null distributions:
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    if n_jobs == None or n_jobs == 1:
+        chunks = [correlation_matrix_chunk(*task) for task in tasks]
+    else:
+        with Pool(processes=n_jobs) as pool:
+            chunks = pool.starmap(correlation_matrix_chunk, tasks)
+    null = np.concatenate(chunks) if len(chunks) > 0 else np.empty((0, std_predictors.shape[1]))
+    null_df = pd.DataFrame(null, columns=predictors.columns)
+    
+    # Compute p-values:
+    observed = pd.Series(std_target @ std_predictors, index=predictors.columns)
+    if two_sided:
+        p_values = (null_df.abs() > observed.abs()).mean()
+    else:
+        p_values = (null_df > observed).mean()
+    
+    return null_df, p_values
+
+
+def p_value(trials, threshold, two_sided=False):
     """
     Compute the right-side p-value by counting the 
     fraction of random `trials` (numerical array-like) 
-    that are greater than `threshold` (number).
+    that are greater than `threshold` (number). If 
+    `two_sided` is True, compare absolute values 
+    instead. NaN trials (e.g. resamples with zero
+    variance) are ignored.
     """
-    pvalue = (trials > threshold).sum() / len(trials)
+    trials = np.asarray(trials)
+    trials = trials[~np.isnan(trials)]
+    if two_sided:
+        pvalue = (np.abs(trials) > np.abs(threshold)).sum() / len(trials)
+    else:
+        pvalue = (trials > threshold).sum() / len(trials)
     return pvalue
 
 
+def wilson_interval_width(n_exceed, n_trials, confidence=0.95):
+    """
+    Return the width of the Wilson score interval,
+    at `confidence` level (float), for a proportion
+    estimated from `n_exceed` (int) successes out of 
+    `n_trials` (int).
+    """
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = n_exceed / n_trials
+    half_width = z * np.sqrt(p * (1 - p) / n_trials + z ** 2 / (4 * n_trials ** 2)) / (1 + z ** 2 / n_trials)
+    
+    return 2 * half_width
+
+
+def streaming_p_value(trial_batches, threshold, two_sided=False, ci_width=None, confidence=0.95, min_trials=1000):
+    """
+    Compute a p-value like `p_value` from batches
+    of random trials, keeping only running counts.
+    
+    Parameters
+    ----------
+    trial_batches : iterable of arrays
+        Batches of random trials, e.g. the output of
+        `iter_bootstrap_correlation`. It is consumed 
+        lazily, so a generator stops producing trials
+        once the p-value is known well enough.
+    threshold : float
+        The observed value of the statistic.
+    two_sided : bool
+        If True, count trials whose absolute values 
+        are greater than the absolute `threshold`.
+        Otherwise, count trials greater than `threshold`.
+    ci_width : float or None
+        Stop consuming batches once the Wilson 
+        confidence interval of the p-value is 
+        narrower than this. If None, consume all 
+        batches.
+    confidence : float
+        Confidence level of the interval above.
+    min_trials : int
+        Minimum number of trials to consume before
+        stopping early.
+    
+    NaN trials (e.g. resamples with zero variance)
+    are ignored.
+    
+    Returns
+    -------
+    pvalue : float
+        Fraction of trials beyond `threshold`.
+    n_trials : int
+        Number of (non-NaN) trials consumed.
+    """
+    
+    n_trials = 0
+    n_exceed = 0
+    for batch in trial_batches:
+        batch = np.asarray(batch)
+        batch = batch[~np.isnan(batch)]
+        
+        # Update counts:
+        if two_sided:
+            n_exceed += int((np.abs(batch) > np.abs(threshold)).sum())
+        else:
+            n_exceed += int((batch > threshold).sum())
+        n_trials += len(batch)
+        
+        # Stop if the p-value is precise enough:
+        if ci_width is not None and n_trials >= min_trials:
+            if wilson_interval_width(n_exceed, n_trials, confidence) <= ci_width:
+                break
+    
+    pvalue = n_exceed / n_trials if n_trials > 0 else np.nan
+    
+    return pvalue, n_trials
+
+
+def bootstrap_p_value(series_a, series_b, n_trials=10000, two_sided=False, ci_width=None, confidence=0.95, chunk_size=10000, random_state=None, min_trials=1000):
+    """
+    Return the p-value (float) of the correlation 
+    between `series_a` (Series) and `series_b` 
+    (Series) under the scrambling of the second 
+    series, along with the number of trials (int) 
+    used, which is at most `n_trials`. 
+    
+    The trials are streamed in chunks of `chunk_size`
+    (int) and never stored. See `streaming_p_value` 
+    for the other parameters.
+    """
+    
+    threshold = compute_correlation(series_a, series_b)
+    chunks = iter_bootstrap_correlation(series_a, series_b, n_trials, chunk_size, random_state)
+    
+    return streaming_p_value(chunks, threshold, two_sided, ci_width, confidence, min_trials)
+
+
 def shuffle_data(data, random_state=None):
     """
     Shuffle the data whiule maintaining 
@@ -1,4 +1,6 @@
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import cpu_count
 
 
 def date_range(first_date, last_date, freq='D'):
@@ -100,3 +102,50 @@ def interleave(l1, l2):
     """
     
     return [val for pair in zip(l1, l2) for val in pair]
+
+
+def parallel_map(func, args_list, n_jobs=None, backend='thread'):
+    """
+    Return a list with `func` (callable) applied 
+    to each tuple of arguments in `args_list` (list
+    of tuples), in the same order.
+    
+    Parameters
+    ----------
+    func : callable
+        Function to apply. For the 'process' backend,
+        it must be defined at the top level of a module.
+    args_list : list of tuples
+        Positional arguments for each call of `func`.
+    n_jobs : int or None
+        Maximum number of workers. If -1, use all 
+        CPUs; if None or 1, run sequentially in the
+        current thread.
+    backend : str
+        Either 'thread' (for functions that release
+        the GIL, e.g. I/O and CSV parsing) or 'process'.
+    
+    Returns
+    -------
+    results : list
+        Outputs of `func` for each element of 
+        `args_list`.
+    """
+    
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    if n_jobs is None or n_jobs == 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+    
+    if backend == 'thread':
+        Executor = ThreadPoolExecutor
+    elif backend == 'process':
+        Executor = ProcessPoolExecutor
+    else:
+        raise ValueError("`backend` should be 'thread' or 'process'.")
+    
+    with Executor(max_workers=min(n_jobs, len(args_list))) as executor:
+        futures = [executor.submit(func, *args) for args in args_list]
+        results = [future.result() for future in futures]
+    
+    return results